@@ -4,7 +4,13 @@ import argparse
 import logging
 import os
 import pkg_resources
-from . import HTTPHose
+from importlib import import_module
+from . import patch
+from .inputs import DEFAULT_SHUFFLE_BUFFER
+from .channel import DEFAULT_PREFETCH
+from .resolver import DEFAULT_TTL
+from .sink import FORMATS
+from .fingerprint import SAMPLE_SIZE
 
 
 class writable_dir(argparse.Action):
@@ -18,7 +24,7 @@ class writable_dir(argparse.Action):
             raise argparse.ArgumentTypeError("{0} is not a writable dir".format(values))
 
 
-def main():
+def make_parser():
     parser = argparse.ArgumentParser(description='Bulk HTTP file enumerator, spaffer of requests and collector of info')
     parser.add_argument('-p', '--progress', action='store_true',
                         help='Show progress bar with ETA')
@@ -30,42 +36,162 @@ def main():
     parser.add_argument('--debug', action='store_const', dest="loglevel",
                         const=logging.DEBUG, default=logging.WARNING,
                         help="Log debugging messages")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="Serve Prometheus metrics on 127.0.0.1:PORT")
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        type=argparse.FileType('a'),
+                        help="Append JSON metrics snapshots to file")
+    parser.add_argument('--metrics-interval', default=10, type=float, metavar='SECS',
+                        help="Seconds between metrics snapshots, default: 10")
+    parser.add_argument('--engine', default='gevent', choices=('gevent', 'asyncio'),
+                        help="Run on gevent, or on asyncio with aiohttp, which "
+                             "supports fewer options, default: gevent")
     parser.add_argument('-e', '--exclude', metavar='TEXT',
                         help='When result text contains this string, ignore like 404')
+    parser.add_argument('--baseline', default=2, type=int, metavar='N',
+                        help="Random nonexistent paths requested per domain to "
+                             "detect soft 404s, 0 to disable, default: 2")
     parser.add_argument('-o', '--output', metavar='OUTJSON',
-                        type=argparse.FileType('a'),
+                        type=argparse.FileType('ab'),
                         help="Output results, as JSON to file")
+    parser.add_argument('-F', '--format', choices=FORMATS,
+                        help="Output file format, default: from file extension, or jsonl")
+    parser.add_argument('--flush-size', default=512, type=int, metavar='N',
+                        help="Write results in batches of up to N, default: 512")
+    parser.add_argument('--flush-interval', default=1.0, type=float, metavar='SECS',
+                        help="Write results at least this often, default: 1")
     parser.add_argument('-n', '--names', metavar='NAMES_FILE',
                         default=pkg_resources.resource_stream(__name__, "common.txt"),
                         type=argparse.FileType('r'),
                         help="Load target directory names from file")
+    parser.add_argument('--names-cache', metavar='DIRECTORY', action=writable_dir,
+                        help="Cache the compiled names list in this dir, keyed on "
+                             "the file's hash, so large lists load quickly")
+    parser.add_argument('--path-stats', metavar='FILE',
+                        help="Probe the names found most often first, counting hits "
+                             "across runs in this file")
+    parser.add_argument('--no-dir-groups', action='store_false', dest='dir_groups',
+                        help="Don't skip names below a directory which is missing")
     parser.add_argument('-b', '--beanstalk', metavar='HOST:PORT',
                         help="Connect to Beanstalk server for jobs")
     parser.add_argument('--tube-fetch', metavar='NAME', default='httphose_jobs',
                         help='Beanstalk tube to fetch jobs from, default: httphose_jobs')
     parser.add_argument('--tube-resp', metavar='NAME', default='httphose_resp',
                         help='Beanstalk tube to respond to, default: httphose_resp')
+    parser.add_argument('--prefetch', default=DEFAULT_PREFETCH, type=int, metavar='N',
+                        help="Beanstalk jobs to reserve ahead, default: %d" % (DEFAULT_PREFETCH,))
+    parser.add_argument('--result-connections', default=2, type=int, metavar='N',
+                        help="Beanstalk connections to put results over, default: 2")
     parser.add_argument('-x', '--extra', metavar='K=V', action='append',
                         help="Extra variables for JSON output")
     parser.add_argument('-d', '--domains', metavar='DOMAINS_FILE',
                         type=argparse.FileType('r'),
-                        help="Load target domains from file")
+                        help="Load target domains from file, - for stdin")
+    parser.add_argument('-S', '--stream', action='store_true',
+                        help="Read domains lazily instead of loading the whole file")
+    parser.add_argument('--shuffle-buffer', default=DEFAULT_SHUFFLE_BUFFER,
+                        type=int, metavar='N',
+                        help="Domains buffered to shuffle streamed input, default: %d" % (
+                            DEFAULT_SHUFFLE_BUFFER,))
+    parser.add_argument('-J', '--journal', metavar='FILE',
+                        help="Record completed work in this file")
+    parser.add_argument('--resume', action='store_true',
+                        help="Skip work recorded in the journal, the domains and "
+                             "names must be the same as the interrupted run")
+    parser.add_argument('-I', '--result-index', metavar='FILE',
+                        help="Keep hits in this SQLite file, later runs ask for them "
+                             "conditionally and only output new or changed hits")
     parser.add_argument('-s', '--storage', metavar='DIRECTORY',
                         action=writable_dir, help="Save files into this dir")
+    parser.add_argument('--max-body', default=1024*1024*10, type=int, metavar='BYTES',
+                        help="Save at most this much of each file, default: 10MiB")
+    parser.add_argument('--body-timeout', default=30, type=float, metavar='SECS',
+                        help="Stop saving a file after this long, default: 30")
+    parser.add_argument('--probe', default='get', choices=('get', 'head', 'range'),
+                        help="Probe with full GETs, HEAD requests or GETs for only the "
+                             "first --probe-bytes (hits are fetched in full for storage), "
+                             "default: get")
+    parser.add_argument('--probe-bytes', default=SAMPLE_SIZE, type=int, metavar='BYTES',
+                        help="Bytes of each response read to check hits, default: %d" % (
+                            SAMPLE_SIZE,))
     parser.add_argument('--redirects', default=4, type=int, metavar='N',
                         help="Maximum number of HTTP Location redirects, default: 4")
+    parser.add_argument('--backend', default='requests', choices=('requests', 'http2'),
+                        help="HTTP client, http2 multiplexes probes to HTTPS hosts "
+                             "over one connection each, falling back to requests for "
+                             "the rest, needs httpx[http2], default: requests")
+    parser.add_argument('--h2-streams', default=32, type=int, metavar='N',
+                        help="Concurrent HTTP requests to a domain answering over "
+                             "HTTP/2, default: 32")
+    parser.add_argument('--keepalive-hosts', default=1000, type=int, metavar='N',
+                        help="Domains to keep idle connections open to, default: 1000")
+    parser.add_argument('--idle', default=30, type=float, metavar='SECS',
+                        help="Close connections idle for this long, default: 30")
     parser.add_argument('-A', '--agent', help="HTTP User Agent, default: random common user-agent")
+    parser.add_argument('--no-dns', action='store_false', dest='dns',
+                        help="Don't resolve domains before probing them")
     parser.add_argument('-R', '--retries', default=2, type=int, metavar='N',
                         help="Retries on failed DNS request, default: 2")
+    parser.add_argument('--resolvers', default=0, type=int, metavar='N',
+                        help="Concurrent DNS requests, default: same as concurrency")
+    parser.add_argument('--dns-ttl', default=DEFAULT_TTL, type=int, metavar='SECS',
+                        help="Cache DNS answers without a known TTL this long, default: %d" % (
+                            DEFAULT_TTL,))
+    parser.add_argument('-W', '--workers', default=1, type=int, metavar='N',
+                        help="Run N processes, domains are split between them by host, default: 1")
     parser.add_argument('-C', '--concurrency', default=20, type=int,
-                        help="Concurrent DNS requests, default: 20", metavar='N')
+                        help="Concurrent HTTP requests, default: 20", metavar='N')
+    parser.add_argument('--adaptive', action='store_true',
+                        help="Adjust concurrency and timeout to the observed error rate and latency, -C is the starting concurrency")
+    parser.add_argument('--min-concurrency', default=5, type=int, metavar='N',
+                        help="Lowest concurrency with --adaptive, default: 5")
+    parser.add_argument('--max-concurrency', default=0, type=int, metavar='N',
+                        help="Highest concurrency with --adaptive, default: 10 times -C")
+    parser.add_argument('--host-failures', default=3, type=int, metavar='N',
+                        help="Give up on a host after N connection failures or "
+                             "timeouts in a row, default: 3")
+    parser.add_argument('--per-host', default=2, type=int, metavar='N',
+                        help="Concurrent HTTP requests to any one domain, default: 2")
+    parser.add_argument('--hosts', default=0, type=int, metavar='N',
+                        help="Domains probed at the same time, default: same as concurrency")
     parser.add_argument('-T', '--timeout', default=1.5, type=float, metavar='SECS',
-                        help="Timeout for DNS request in seconds, default: 1.5")
+                        help="Timeout for DNS and HTTP requests in seconds, default: 1.5")
     parser.add_argument('domain', nargs='*', help='One or more domains')
-    args = parser.parse_args()
-    logging.basicConfig(level=args.loglevel)
+    return parser
+
+
+def parse_args(parser, argv=None):
+    args = parser.parse_args(argv)
     args.extra = dict([X.split('=', 1) for X in args.extra or []])
-    program = HTTPHose(args)
+    return args
+
+
+def main():
+    parser = make_parser()
+    args = parse_args(parser)
+    logging.basicConfig(level=args.loglevel)
+    if args.engine == 'asyncio':
+        from .aio import AsyncHose, unsupported
+        options = unsupported(args)
+        if options:
+            parser.error("not supported with --engine asyncio: %s" % (', '.join(options),))
+        program = AsyncHose(args)
+    else:
+        if args.backend == 'http2':
+            # Before patching: httpx's transport, httpcore, imports trio when
+            # it's installed, and trio can't be imported once select is patched
+            try:
+                import_module('httpx')
+                import_module('httpcore')
+            except ImportError:
+                parser.error("--backend http2 needs httpx, install httpx[http2]")
+        patch()
+        from .hose import HTTPHose
+        from .shards import ShardedHose
+        if args.workers > 1:
+            program = ShardedHose(args)
+        else:
+            program = HTTPHose(args)
     if not program.valid():
         parser.print_help()
         return 1
@@ -0,0 +1,583 @@
+"""
+The hose on asyncio, for running inside an existing event loop without
+monkey-patching anything. Needs Python 3.7 and `aiohttp`.
+
+    from httphose.aio import probe
+
+    async for result in probe(['example.com'], ['.git/config', 'backup.sql']):
+        print(result['url'])
+
+Results are the same dicts as the gevent engine outputs. From the command
+line it's `--engine asyncio`, which supports domains from the arguments,
+files or beanstalk, and most options besides multiple processes, storage,
+the journal, the result index and adaptive concurrency.
+"""
+from __future__ import absolute_import, print_function
+import time
+import random
+import socket
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .inputs import load_domains
+from .names import NamesIndex
+from .paths import PathStats, PathPlan, MISSING_STATUS, is_requested
+from .fingerprint import (Fingerprint, FingerprintCache, baseline_names,
+                          is_soft404)
+from .metrics import Metrics
+from .control import (retry_after, THROTTLE_STATUS, BACKOFF_ERRORS,
+                      BACKOFF_BASE, MAX_BACKOFF, MAX_STRIKES, NAME_RETRIES)
+from .channel import (ChannelJob, connect_beanstalk, iter_batches, job_ttr,
+                      pack_lines, send_ack, touch_jobs, release_jobs,
+                      RESERVE_TIMEOUT)
+from .sink import ResultOutput
+from .transport import DRAIN_LIMIT, HTTP_USER_AGENTS, whole_file
+
+
+LOG = logging.getLogger(__name__)
+
+# Options only the gevent engine implements, with their default values
+GEVENT_ONLY = (
+    ('workers', 1),
+    ('storage', None),
+    ('journal', None),
+    ('resume', False),
+    ('result_index', None),
+    ('adaptive', False),
+    ('backend', 'requests'),
+    ('metrics_port', None),
+    ('metrics_file', None),
+    ('progress', False),
+)
+
+
+def unsupported(options):
+    """Command line flags set which the asyncio engine doesn't implement"""
+    return ['--' + name.replace('_', '-') for name, default in GEVENT_ONLY
+            if getattr(options, name, default) != default]
+
+
+def classify_error(exc):
+    """Error class for a failed aiohttp request, as `metrics.classify_error`"""
+    import aiohttp
+    if isinstance(exc, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(exc, (aiohttp.ClientSSLError,
+                        aiohttp.ClientConnectorCertificateError)):
+        return 'tls'
+    if isinstance(exc, aiohttp.ClientConnectorError):
+        if isinstance(exc.os_error, socket.gaierror) or \
+                type(exc).__name__ == 'ClientConnectorDNSError':
+            return 'dns'
+        return 'connect'
+    if isinstance(exc, (aiohttp.ClientOSError, aiohttp.ServerDisconnectedError)):
+        return 'connect'
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return 'http'
+    return 'other'
+
+
+class AsyncWorker(object):
+    """
+    Probes the names for one domain, `--per-host` at a time, following the
+    hose's `PathPlan`: names below a directory are probed once it's been
+    found not to be missing. Like the gevent `Worker` the baseline comes
+    first, and throttling or failing hosts are paused with a growing delay,
+    then given up on.
+    """
+    __slots__ = ('hose', 'domain', 'extra', 'url', 'prefix', 'quoted',
+                 'headers', 'method', 'baseline', 'entries', 'strikes',
+                 'failures', 'resume_at', 'abandoned', 'results')
+
+    def __init__(self, hose, domain, extra, results):
+        options = hose.options
+        self.hose = hose
+        self.domain = domain
+        self.extra = extra
+        self.results = results
+        url = domain.strip('/')
+        if not url.startswith('http://') and not url.startswith('https://'):
+            url = 'http://' + url
+        self.url = url
+        self.prefix = url + '/'
+        self.quoted = hose.names_index.quoted
+        self.headers = {
+            'User-Agent': options.agent or random.choice(HTTP_USER_AGENTS)
+        }
+        if options.probe == 'range':
+            self.headers['Range'] = 'bytes=0-%d' % (options.probe_bytes - 1,)
+        self.method = 'HEAD' if options.probe == 'head' else 'GET'
+        self.baseline = hose.fingerprints.get(url)
+        self.entries = deque(hose.plan.entries)
+        self.strikes = 0
+        self.failures = 0
+        self.resume_at = 0
+        self.abandoned = False
+
+    async def run(self):
+        if self.baseline is None and self.hose.options.baseline > 0:
+            self.baseline = []
+            await asyncio.gather(*[self._probe(name, True) for name in
+                                   baseline_names(self.hose.options.baseline)])
+            self.hose.fingerprints.put(self.url, self.baseline)
+        await asyncio.gather(*[self._drain() for _ in
+                               range(max(1, self.hose.options.per_host))])
+
+    async def _drain(self):
+        metrics = self.hose.metrics
+        while self.entries and not self.abandoned:
+            entry = self.entries.popleft()
+            if not isinstance(entry, tuple):
+                await self._probe(entry)
+                continue
+            directory, names = entry
+            status = await self._probe(directory)
+            if status in MISSING_STATUS:
+                metrics.incr('skipped', len(names))
+            else:
+                # Probed before the rest of the plan, as with the gevent engine
+                self.entries.extendleft(reversed(names))
+
+    def _backoff(self, delay=None):
+        """Pause the host, returns False when it's been given up on"""
+        self.strikes += 1
+        if self.strikes > MAX_STRIKES:
+            LOG.info("Giving up on %r after %d failures in a row",
+                     self.domain, self.strikes - 1)
+            self.abandoned = True
+            return False
+        if delay is None:
+            delay = BACKOFF_BASE * 2 ** (self.strikes - 1)
+        self.resume_at = max(self.resume_at, time.time() + min(delay, MAX_BACKOFF))
+        return True
+
+    async def _probe(self, name, calibrating=False):
+        """Returns the response status, None when there wasn't one"""
+        from yarl import URL
+        hose = self.hose
+        options = hose.options
+        metrics = hose.metrics
+        name_url = self.prefix + self.quoted.get(name, name)
+        retries = 0
+        requested = False
+        try:
+            while not self.abandoned:
+                delay = self.resume_at - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                metrics.incr('requests')
+                requested = True
+                start = time.time()
+                try:
+                    async with hose.session.request(
+                            self.method, URL(name_url, encoded=True),
+                            headers=self.headers, allow_redirects=True,
+                            max_redirects=options.redirects) as resp:
+                        metrics.observe('ttfb', time.time() - start)
+                        metrics.response(resp.status)
+                        if resp.status in THROTTLE_STATUS:
+                            metrics.incr('throttled')
+                            delay = retry_after(resp)
+                        else:
+                            self.strikes = 0
+                            self.failures = 0
+                            try:
+                                await self._handle(name, name_url, resp, calibrating)
+                            finally:
+                                await self._release(resp)
+                            return resp.status
+                except Exception as ex:
+                    error = classify_error(ex)
+                    metrics.error(error)
+                    LOG.debug("Failed to request %r: %r", name_url, ex)
+                    if error not in BACKOFF_ERRORS:
+                        return None
+                    self.failures += 1
+                    if self.failures >= options.host_failures:
+                        LOG.info("Giving up on %r after %d failed requests in a row",
+                                 self.domain, self.failures)
+                        self.abandoned = True
+                        return None
+                    delay = None
+                if not self._backoff(delay) or calibrating or retries >= NAME_RETRIES:
+                    return None
+                retries += 1
+            return None
+        finally:
+            # Counted once per name as the gevent engine does, retries
+            # are part of the same probe
+            if requested and not calibrating and hose.stats \
+                    and name not in hose.plan.synthetic:
+                hose.stats.probed(name)
+
+    async def _handle(self, name, name_url, resp, calibrating):
+        hose = self.hose
+        ok = resp.status >= 200 and resp.status < 300
+        if calibrating:
+            # Redirected elsewhere, it's not what a hit would look like
+            if ok and is_requested(str(resp.url), name_url):
+                head = await self._read_head(resp)
+                self.baseline.append(Fingerprint(resp.status, resp.headers,
+                                                 head, name))
+            return
+        if not ok or name in hose.plan.synthetic:
+            return
+        if not is_requested(str(resp.url), name_url):
+            return
+        head = await self._read_head(resp)
+        if is_soft404(resp.status, resp.headers, head, name, self.baseline,
+                      hose.options.exclude):
+            hose.metrics.incr('suppressed')
+            return
+        if hose.stats:
+            hose.stats.hit(name)
+        await self.results.put(hose.result(name_url, resp, self.extra))
+
+    async def _read_head(self, resp):
+        if self.method == 'HEAD':
+            return b''
+        start = time.time()
+        try:
+            head = await resp.content.readexactly(self.hose.options.probe_bytes)
+        except asyncio.IncompleteReadError as ex:
+            head = ex.partial
+        self.hose.metrics.observe('body', time.time() - start)
+        return head
+
+    async def _release(self, resp, limit=DRAIN_LIMIT):
+        """Read what's left of a small body so the connection is reused,
+        larger ones are abandoned with the connection"""
+        try:
+            while limit > 0:
+                chunk = await resp.content.readany()
+                if not chunk:
+                    return
+                limit -= len(chunk)
+        except Exception:
+            pass
+        resp.close()
+
+
+class AsyncChannel(object):
+    """
+    Beanstalk jobs for the asyncio engine. beanstalkc blocks, so each of its
+    two connections is only used from its own thread: one reserves, touches
+    and deletes jobs, the other puts results. Jobs are `ChannelJob`s, deleted
+    once every domain from them has been probed.
+    """
+    __slots__ = ('options', 'reader', 'writer', 'reading', 'writing', 'jobs',
+                 'acks', 'toucher')
+
+    def __init__(self, options):
+        self.options = options
+        self.reader = None
+        self.writer = None
+        self.reading = ThreadPoolExecutor(1)
+        self.writing = ThreadPoolExecutor(1)
+        self.jobs = dict()
+        # Acknowledgements not yet sent, waited for on close
+        self.acks = set()
+        self.toucher = None
+
+    def _call(self, executor, func, *args):
+        return asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def start(self):
+        options = self.options
+        self.writer = await self._call(self.writing, connect_beanstalk,
+                                       options.beanstalk)
+        await self._call(self.writing, self.writer.use, options.tube_resp)
+        self.reader = await self._call(self.reading, connect_beanstalk,
+                                       options.beanstalk, True)
+        await self._call(self.reading, self.reader.watch, options.tube_fetch)
+        self.toucher = asyncio.ensure_future(self._touch_forever())
+        LOG.info("Connected to beanstalk @ %r - fetch: %r - resp: %r",
+                 options.beanstalk, options.tube_fetch, options.tube_resp)
+
+    async def work(self):
+        """(domain, extra, job) for the domains of reserved jobs, forever"""
+        await self.start()
+        while True:
+            try:
+                job = await self._call(self.reading, self.reader.reserve,
+                                       RESERVE_TIMEOUT)
+            except Exception:
+                LOG.exception("Failed to reserve job")
+                await asyncio.sleep(RESERVE_TIMEOUT)
+                continue
+            if job is None:
+                continue
+            job = ChannelJob(self, job, await self._call(self.reading, job_ttr, job))
+            self.jobs[job.jid] = job
+            LOG.info("Processing job: %r", job.jid)
+            try:
+                for domain_list, extra in iter_batches(job.job.body):
+                    for domain in domain_list:
+                        job.add()
+                        yield domain, extra, job
+            except ValueError as ex:
+                LOG.warning("Job %r: invalid, %s", job.jid, ex)
+                job.fail()
+                continue
+            job.complete()
+
+    def ack(self, job, action):
+        """Delete or bury the job, from the reading thread"""
+        if self.jobs.pop(job.jid, None) is not None:
+            future = self._call(self.reading, send_ack, job, action)
+            self.acks.add(future)
+            future.add_done_callback(self.acks.discard)
+
+    async def _touch_forever(self):
+        while True:
+            await asyncio.sleep(RESERVE_TIMEOUT)
+            await self._call(self.reading, touch_jobs, self.jobs)
+
+    async def put_lines(self, lines):
+        for body in pack_lines(lines):
+            await self._call(self.writing, self.writer.put, body)
+
+    def _close(self):
+        release_jobs(self.jobs)
+        self.reader.close()
+
+    async def close(self):
+        if self.toucher is not None:
+            self.toucher.cancel()
+        if self.acks:
+            await asyncio.gather(*list(self.acks))
+        if self.reader is not None:
+            await self._call(self.reading, self._close)
+        if self.writer is not None:
+            await self._call(self.writing, self.writer.close)
+        self.reading.shutdown()
+        self.writing.shutdown()
+
+
+class ResultWriter(object):
+    """
+    Results printed, written to `--output` and put onto beanstalk, in
+    batches of up to `--flush-size` or whatever arrived within
+    `--flush-interval` seconds, as the gevent engine's `ResultSink`.
+    """
+    __slots__ = ('output', 'channel', 'flush_size', 'flush_interval', 'batch',
+                 'flusher')
+
+    def __init__(self, options, channel=None):
+        self.output = ResultOutput(options)
+        self.channel = channel
+        self.flush_size = max(1, options.flush_size)
+        self.flush_interval = options.flush_interval
+        self.batch = []
+        self.flusher = None
+
+    def start(self):
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self._flush_forever())
+
+    async def put(self, status):
+        self.batch.append(status)
+        if len(self.batch) >= self.flush_size:
+            await self.flush()
+
+    async def flush(self):
+        batch, self.batch = self.batch, []
+        batch, lines = self.output.write(batch)
+        if lines and self.channel:
+            try:
+                await self.channel.put_lines(lines)
+            except Exception:
+                LOG.exception("Failed to put %d results", len(batch))
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+        self.output.close()
+
+
+class AsyncHose(object):
+    """
+    The hose on asyncio: names are probed over pooled aiohttp connections,
+    at most `--concurrency` at once and `--per-host` to any one domain, for
+    up to `--hosts` domains at a time. `results()` is an async generator of
+    the result dicts, `run()` is the command line program.
+    """
+    __slots__ = ('options', 'domains', 'names_index', 'names', 'stats', 'plan',
+                 'fingerprints', 'metrics', 'session')
+
+    def __init__(self, options):
+        self.options = options
+        self.metrics = Metrics()
+        self.fingerprints = FingerprintCache()
+        self.domains = None if options.beanstalk else load_domains(options)
+        names = options.names
+        if not isinstance(names, NamesIndex):
+            names = NamesIndex.load(names, getattr(options, 'names_cache', None))
+        self.names_index = names
+        self.names = names.names
+        self.stats = PathStats(options.path_stats) if options.path_stats else None
+        self.plan = PathPlan(self.names, self.stats, options.dir_groups)
+        self.session = None
+        LOG.info("%d file names", len(self.names))
+
+    def valid(self):
+        return bool(self.options.beanstalk or self.domains)
+
+    def _session(self):
+        import aiohttp
+        options = self.options
+        connector = aiohttp.TCPConnector(limit=options.concurrency,
+                                         limit_per_host=options.per_host,
+                                         ssl=False, ttl_dns_cache=options.dns_ttl,
+                                         keepalive_timeout=options.idle or None)
+        timeout = aiohttp.ClientTimeout(sock_connect=options.timeout,
+                                        sock_read=options.timeout)
+        # Cookies are reported per-response, a shared jar would only grow
+        return aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                     cookie_jar=aiohttp.DummyCookieJar())
+
+    def result(self, url, resp, extra=None):
+        """The result dict for a hit, as `HTTPHose.on_result` makes"""
+        code, length = whole_file(resp.status, resp.headers)
+        status = dict(
+            url=str(resp.url) or url,
+            hist=[(hist.status, str(hist.url)) for hist in resp.history],
+            sc=code,
+            hds=list(dict.fromkeys(resp.headers.keys())),
+            cks=list(resp.cookies.keys()),
+            hd={k: v for k, v in dict(
+                lm=resp.headers.get('Last-Modified'),
+                ct=resp.headers.get('Content-Type'),
+                cl=length,
+                sv=resp.headers.get('Server'),
+            ).items() if v}
+        )
+        if extra and isinstance(extra, dict):
+            status.update(extra)
+        if self.options.extra:
+            status.update(self.options.extra)
+        self.metrics.incr('hits')
+        return status
+
+    async def _probe_domain(self, domain, extra, results):
+        try:
+            await AsyncWorker(self, domain, extra, results).run()
+        except Exception:
+            LOG.exception("While probing %r", domain)
+        self.metrics.incr('domains')
+
+    async def _feed(self, work, results):
+        hosts = asyncio.Semaphore(self.options.hosts or self.options.concurrency)
+        tasks = set()
+
+        def finished(task, job):
+            tasks.discard(task)
+            hosts.release()
+            if job is not None:
+                job.done()
+        try:
+            async for domain, extra, job in work:
+                await hosts.acquire()
+                task = asyncio.ensure_future(self._probe_domain(domain, extra, results))
+                tasks.add(task)
+                task.add_done_callback(lambda task, job=job: finished(task, job))
+            while tasks:
+                await asyncio.wait(list(tasks))
+        except asyncio.CancelledError:
+            for task in list(tasks):
+                task.cancel()
+            raise
+        except Exception:
+            for task in list(tasks):
+                task.cancel()
+            await results.put(None)
+            raise
+        await results.put(None)
+
+    async def _results(self, work):
+        results = asyncio.Queue(max(1, self.options.flush_size))
+        async with self._session() as session:
+            self.session = session
+            feeder = asyncio.ensure_future(self._feed(work, results))
+            try:
+                while True:
+                    status = await results.get()
+                    if status is None:
+                        break
+                    yield status
+                await feeder
+            finally:
+                feeder.cancel()
+                self.session = None
+
+    async def results(self, domains, extra=None):
+        """Results for every name on each of `domains`, as they're found,
+        `domains` can be an iterable or an async iterable"""
+        async def work():
+            if hasattr(domains, '__aiter__'):
+                async for domain in domains:
+                    yield domain, extra, None
+            else:
+                for domain in domains:
+                    yield domain, extra, None
+        async for status in self._results(work()):
+            yield status
+
+    async def _main(self):
+        channel = AsyncChannel(self.options) if self.options.beanstalk else None
+        writer = ResultWriter(self.options, channel)
+        writer.start()
+        try:
+            if channel:
+                results = self._results(channel.work())
+            else:
+                results = self.results(domain for _, domain in self.domains)
+            async for status in results:
+                await writer.put(status)
+        finally:
+            await writer.close()
+            if channel:
+                await channel.close()
+
+    def run(self):
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt:
+            print("Ctrl+C caught... stopping")
+        if self.stats:
+            self.stats.save()
+
+
+async def probe(domains, names=None, **options):
+    """
+    Results of probing `names` on each of `domains`, as they're found.
+    `names` is a list, an open file or a `NamesIndex`, by default the
+    packaged list. Other options are those of the command line, by their
+    long names: `probe(domains, per_host=4, timeout=5)`.
+    """
+    from .__main__ import make_parser, parse_args
+    args = parse_args(make_parser(), [])
+    for key, value in options.items():
+        if not hasattr(args, key):
+            raise TypeError("unknown option %r" % (key,))
+        setattr(args, key, value)
+    flags = unsupported(args)
+    if flags:
+        raise ValueError("not supported by the asyncio engine: %s" % (', '.join(flags),))
+    if isinstance(names, (list, tuple)):
+        names = NamesIndex.from_lines(names)
+    if names is not None:
+        args.names = names
+    args.domain = []
+    hose = AsyncHose(args)
+    async for status in hose.results(domains):
+        yield status
@@ -0,0 +1,857 @@
+"""
+Benchmarks against a mock internet on the loopback interface, no requests
+leave the machine. A separate process serves any number of virtual hosts
+over HTTP and HTTPS, and a fake beanstalkd. In the benchmark process every
+`*.bench.test` name resolves to the loopback interface.
+
+    python -mhttphose.bench --hosts 100 -- -C 50 --adaptive
+
+Arguments after `--` are passed to the hose. Besides the numbers, the hits
+found are checked against those the mock hosts serve, so a change which
+is faster because it finds less is caught.
+"""
+from __future__ import absolute_import, print_function
+# The mock servers, and the hose, run on gevent
+from importlib import import_module
+from . import patch
+try:
+    # For `--backend http2`, imported before patching as httpcore imports
+    # trio when it's installed, which can't be imported once select is patched
+    import_module('httpx')
+    import_module('httpcore')
+except ImportError:
+    pass
+patch()
+import os
+import re
+import ssl
+import sys
+import json
+import time
+import zlib
+import errno
+import random
+import shutil
+import signal
+import socket
+import logging
+import argparse
+import resource
+import itertools
+import subprocess
+import tempfile
+from collections import deque
+
+import gevent
+import gevent.event
+import gevent.server
+import pkg_resources
+
+from .hose import HTTPHose
+from .__main__ import make_parser as make_hose_parser
+from .__main__ import parse_args as parse_hose_args
+from .makework import MakeWorkProgram
+from .makework import make_parser as make_makework_parser
+from .makework import parse_args as parse_makework_args
+from .metrics import LATENCY_BUCKETS
+from .names import NamesIndex
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+
+LOG = logging.getLogger(__name__)
+
+# How virtual hosts behave, chosen by their name, e.g. `h12-slow.bench.test`
+KINDS = ('static', 'catchall', 'slow', 'tarpit', 'redirect', 'large')
+DEFAULT_MIX = 'static=70,catchall=10,slow=5,tarpit=2,redirect=8,large=5'
+DOMAIN_SUFFIX = '.bench.test'
+
+# Kinds of host whose hits are expected to be reported
+HIT_KINDS = ('static', 'slow', 'redirect', 'large')
+
+# One in this many names exists on each host
+HIT_ONE_IN = 40
+
+# Names below one directory, listed last so every host's plan ends on a
+# group, which is only probed once the directory was found. The first of
+# them is a hit on every host.
+END_GROUP = ['bench-end/%s' % (word,) for word in ('alpha0', 'bravo0', 'delta0')]
+
+# Only names which survive being put in a URL unchanged can be hits
+_HIT_NAME = re.compile(r'^[A-Za-z0-9_.~-]+(/[A-Za-z0-9_.~-]+)*/?$')
+
+_WORDS = ['%s%d' % (word, idx) for idx in range(10) for word in
+          ('alpha', 'bravo', 'delta', 'echo', 'gamma', 'kilo', 'lima', 'oscar')]
+
+SLOW_DELAY = 0.05
+LARGE_SIZE = 1024 * 1024 * 2
+LOGIN_PATH = '/login'
+MAX_LINE = 1024 * 8
+
+CATCHALL_PAGE = (b'<html><head><title>Welcome</title></head><body>' +
+                 b'<p>This domain is parked, what you are looking for may '
+                 b'be somewhere else. Try searching from our home page.</p>' * 20 +
+                 b'</body></html>')
+
+LOGIN_PAGE = (b'<html><head><title>Sign in</title></head><body><form>'
+              b'<p>Please sign in to continue</p><input name="user">'
+              b'<input name="password" type="password"></form></body></html>')
+
+REASONS = {200: 'OK', 206: 'Partial Content', 302: 'Found', 403: 'Forbidden',
+           404: 'Not Found'}
+
+# Default beanstalkd limit
+MAX_JOB_BYTES = 65535
+
+
+def host_kind(host):
+    label = host.split('.', 1)[0]
+    return label.split('-', 1)[-1]
+
+
+def _crc(host, name):
+    return zlib.crc32(('%s/%s' % (host, name)).encode('utf-8')) & 0xFFFFFFFF
+
+
+def is_hit(host, name, names):
+    """Whether the host serves the name, only names from the list can be
+    hits, so the hose's random baseline names never are"""
+    if name == END_GROUP[0]:
+        return name in names
+    return name in names and bool(_HIT_NAME.match(name)) and '..' not in name and \
+        _crc(host, name) % HIT_ONE_IN == 0
+
+
+def hit_body(host, name):
+    """Page for a hit, distinct even with the name taken out of it"""
+    words = random.Random(_crc(host, name)).sample(_WORDS, 30)
+    return ('<html><body><h1>%s</h1><p>%s</p></body></html>' % (
+        name, ' '.join(words))).encode('utf-8')
+
+
+def load_names(path, count=0):
+    with open(path) as handle:
+        names = NamesIndex.from_lines(handle).names
+    return names[:count] if count else names
+
+
+def make_hosts(count, mix, https_percent, seed, port, tls_port):
+    """(url, host, kind) for `count` virtual hosts, kinds in proportion to `mix`"""
+    weights = []
+    for item in mix.split(','):
+        kind, weight = item.split('=')
+        if kind not in KINDS:
+            raise ValueError("unknown kind of host: %r" % (kind,))
+        weights.append((kind, float(weight)))
+    total = sum([weight for _, weight in weights])
+    kinds = []
+    for kind, weight in weights:
+        kinds += [kind] * int(round(count * weight / total))
+    kinds = (kinds + [weights[0][0]] * count)[:count]
+    random.Random(seed).shuffle(kinds)
+    hosts = []
+    for idx, kind in enumerate(kinds):
+        host = 'h%d-%s%s' % (idx, kind, DOMAIN_SUFFIX)
+        if tls_port and idx % 100 < https_percent:
+            url = 'https://%s:%d' % (host, tls_port)
+        else:
+            url = 'http://%s:%d' % (host, port)
+        hosts.append((url, host, kind))
+    return hosts
+
+
+def make_certificate(workdir):
+    """Throwaway self-signed certificate for the HTTPS hosts"""
+    cert = os.path.join(workdir, 'cert.pem')
+    key = os.path.join(workdir, 'key.pem')
+    with open(os.devnull, 'wb') as devnull:
+        try:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                                   '-nodes', '-days', '1', '-keyout', key, '-out', cert,
+                                   '-subj', '/CN=' + DOMAIN_SUFFIX.lstrip('.')],
+                                  stdout=devnull, stderr=devnull)
+        except (OSError, subprocess.CalledProcessError):
+            LOG.warning("Can't generate a certificate with openssl, no HTTPS hosts")
+            return None, None
+    return cert, key
+
+
+def _quantile(hist, fraction):
+    """Quantile of a histogram snapshot, interpolated within its bucket"""
+    if not hist['count']:
+        return None
+    wanted = hist['count'] * fraction
+    seen = 0
+    lower = 0.0
+    for idx, count in enumerate(hist['buckets']):
+        if idx == len(LATENCY_BUCKETS):
+            return lower
+        upper = LATENCY_BUCKETS[idx]
+        if count and seen + count >= wanted:
+            return lower + (upper - lower) * (wanted - seen) / count
+        seen += count
+        lower = upper
+    return lower
+
+
+def _listen(port, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(1024)
+    return sock
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_listening(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            gevent.sleep(0.05)
+
+
+def _rusage_dict(usage):
+    return dict(cpu=round(usage.ru_utime + usage.ru_stime, 3),
+                maxrss_kb=usage.ru_maxrss)
+
+
+class MockInternet(object):
+    """
+    HTTP server which answers for every virtual host, behaving as the name
+    in the Host header says. The HTTPS listener uses a self-signed
+    certificate, the hose doesn't verify them.
+    """
+    __slots__ = ('names', 'directories', 'ssl_context', 'large')
+
+    def __init__(self, names, certfile=None, keyfile=None):
+        self.names = names
+        self.directories = dict()
+        self.ssl_context = None
+        if certfile:
+            protocol = getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23)
+            self.ssl_context = ssl.SSLContext(protocol)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.large = b'0123456789abcdef' * (LARGE_SIZE // 16)
+
+    def handle(self, sock, address, scheme='http'):
+        reader = None
+        try:
+            if scheme == 'https':
+                sock = self.ssl_context.wrap_socket(sock, server_side=True)
+            reader = sock.makefile('rb')
+            self._serve(sock, reader, scheme)
+        except (socket.error, ssl.SSLError):
+            pass
+        finally:
+            if reader is not None:
+                reader.close()
+            sock.close()
+
+    def handle_tls(self, sock, address):
+        self.handle(sock, address, 'https')
+
+    def _serve(self, sock, reader, scheme):
+        while True:
+            line = reader.readline(MAX_LINE)
+            if not line:
+                return
+            parts = line.decode('latin-1').split()
+            if len(parts) != 3:
+                return
+            method, path, version = parts
+            headers = dict()
+            while True:
+                line = reader.readline(MAX_LINE)
+                if not line.strip():
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get('content-length') or 0)
+            if length:
+                reader.read(length)
+            host = headers.get('host', '').split(':')[0].lower()
+            if not self._respond(sock, method, scheme, host, path, headers):
+                return
+            if version == 'HTTP/1.0' or headers.get('connection', '').lower() == 'close':
+                return
+
+    def _is_directory(self, host, name):
+        """Directories with hits below them exist, but can't be listed"""
+        prefix = name.rstrip('/') + '/'
+        key = (host, prefix)
+        found = self.directories.get(key)
+        if found is None:
+            found = self.directories[key] = any([
+                is_hit(host, other, self.names) for other in self.names
+                if other.startswith(prefix) and other != prefix])
+        return found
+
+    def _respond(self, sock, method, scheme, host, path, headers):
+        """Returns False when the connection is to be closed"""
+        kind = host_kind(host)
+        name = unquote(path.split('?', 1)[0].lstrip('/'))
+        extra = []
+        if kind == 'tarpit':
+            # Hold the request until the client gives up
+            sock.recv(1)
+            return False
+        if kind == 'slow':
+            gevent.sleep(SLOW_DELAY)
+        if kind == 'catchall':
+            status, body = 200, CATCHALL_PAGE
+        elif is_hit(host, name, self.names):
+            status = 200
+            body = self.large if kind == 'large' else hit_body(host, name)
+        elif kind == 'redirect':
+            if path == LOGIN_PATH:
+                status, body = 200, LOGIN_PAGE
+            else:
+                status, body = 302, b''
+                extra.append('Location: %s://%s%s' % (scheme, headers['host'], LOGIN_PATH))
+        elif name and self._is_directory(host, name):
+            status, body = 403, b'<html><body>Forbidden</body></html>'
+        else:
+            status, body = 404, b'<html><body>Not Found</body></html>'
+        match = re.match(r'bytes=(\d+)-(\d*)$', headers.get('range', ''))
+        if status == 200 and match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(body) - 1
+            extra.append('Content-Range: bytes %d-%d/%d' % (start, end, len(body)))
+            status, body = 206, body[start:end + 1]
+        head = ['HTTP/1.1 %d %s' % (status, REASONS[status]),
+                'Server: httphose-bench',
+                'Content-Type: text/html',
+                'Content-Length: %d' % (len(body),)] + extra
+        data = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+        if method != 'HEAD':
+            data += body
+        sock.sendall(data)
+        return True
+
+
+class FakeBeanstalkd(object):
+    """
+    Enough of the beanstalkd protocol for the hose and makework: put,
+    reserve, delete, release, bury, touch and stats. TTRs aren't enforced,
+    jobs reserved by a connection are released when it closes.
+    """
+    __slots__ = ('jobs', 'ready', 'waiters', 'ids')
+
+    def __init__(self):
+        # id -> [tube, body, state, ttr]
+        self.jobs = dict()
+        self.ready = dict()
+        self.waiters = dict()
+        self.ids = itertools.count(1)
+
+    def _make_ready(self, jid):
+        job = self.jobs[jid]
+        waiters = self.waiters.get(job[0])
+        while waiters:
+            waiter = waiters.pop(0)
+            if not waiter.ready():
+                job[2] = 'reserved'
+                waiter.set(jid)
+                return
+        job[2] = 'ready'
+        self.ready.setdefault(job[0], deque()).append(jid)
+
+    def _reserve(self, watching, timeout):
+        for tube in watching:
+            queue = self.ready.get(tube)
+            while queue:
+                jid = queue.popleft()
+                job = self.jobs.get(jid)
+                if job is not None and job[2] == 'ready':
+                    job[2] = 'reserved'
+                    return jid
+        if timeout == 0:
+            return None
+        waiter = gevent.event.AsyncResult()
+        for tube in watching:
+            self.waiters.setdefault(tube, []).append(waiter)
+        try:
+            return waiter.get(timeout=timeout)
+        except gevent.Timeout:
+            return waiter.value if waiter.ready() else None
+        finally:
+            for tube in watching:
+                if waiter in self.waiters.get(tube, ()):
+                    self.waiters[tube].remove(waiter)
+
+    def _stats_tube(self, tube):
+        counts = dict(ready=0, reserved=0, buried=0)
+        for job in self.jobs.values():
+            if job[0] == tube:
+                counts[job[2]] += 1
+        return ('name: %s\ncurrent-jobs-ready: %d\ncurrent-jobs-reserved: %d\n'
+                'current-jobs-buried: %d\n' % (tube, counts['ready'],
+                                                counts['reserved'], counts['buried']))
+
+    def handle(self, sock, address):
+        reader = sock.makefile('rb')
+        reserved = set()
+        try:
+            self._serve(sock, reader, reserved)
+        except socket.error:
+            pass
+        finally:
+            for jid in reserved:
+                if jid in self.jobs:
+                    self._make_ready(jid)
+            reader.close()
+            sock.close()
+
+    def _serve(self, sock, reader, reserved):
+        using = 'default'
+        watching = ['default']
+        while True:
+            line = reader.readline(MAX_LINE)
+            if not line:
+                return
+            parts = line.decode('ascii').split()
+            if not parts:
+                continue
+            cmd, args = parts[0], parts[1:]
+            jid = int(args[0]) if args and args[0].isdigit() else None
+            data = None
+            if cmd == 'put':
+                size = int(args[3])
+                body = reader.read(size + 2)[:-2]
+                if size > MAX_JOB_BYTES:
+                    reply = 'JOB_TOO_BIG'
+                else:
+                    jid = next(self.ids)
+                    self.jobs[jid] = [using, body, None, int(args[2])]
+                    self._make_ready(jid)
+                    reply = 'INSERTED %d' % (jid,)
+            elif cmd == 'use':
+                using = args[0]
+                reply = 'USING %s' % (using,)
+            elif cmd == 'watch':
+                if args[0] not in watching:
+                    watching.append(args[0])
+                reply = 'WATCHING %d' % (len(watching),)
+            elif cmd == 'ignore':
+                if watching == [args[0]]:
+                    reply = 'NOT_IGNORED'
+                else:
+                    if args[0] in watching:
+                        watching.remove(args[0])
+                    reply = 'WATCHING %d' % (len(watching),)
+            elif cmd in ('reserve', 'reserve-with-timeout'):
+                jid = self._reserve(watching, int(args[0]) if args else None)
+                if jid is None:
+                    reply = 'TIMED_OUT'
+                else:
+                    reserved.add(jid)
+                    data = self.jobs[jid][1]
+                    reply = 'RESERVED %d %d' % (jid, len(data))
+            elif cmd == 'delete':
+                job = self.jobs.get(jid)
+                if job is None or (job[2] == 'reserved' and jid not in reserved):
+                    reply = 'NOT_FOUND'
+                else:
+                    reserved.discard(jid)
+                    del self.jobs[jid]
+                    reply = 'DELETED'
+            elif cmd in ('release', 'bury', 'touch'):
+                if jid not in reserved or jid not in self.jobs:
+                    reply = 'NOT_FOUND'
+                elif cmd == 'touch':
+                    reply = 'TOUCHED'
+                else:
+                    reserved.discard(jid)
+                    if cmd == 'release':
+                        self._make_ready(jid)
+                        reply = 'RELEASED'
+                    else:
+                        self.jobs[jid][2] = 'buried'
+                        reply = 'BURIED'
+            elif cmd == 'stats-job':
+                job = self.jobs.get(jid)
+                if job is None:
+                    reply = 'NOT_FOUND'
+                else:
+                    data = ('---\nid: %d\ntube: %s\nstate: %s\nttr: %d\n' % (
+                        jid, job[0], job[2], job[3])).encode('ascii')
+            elif cmd == 'stats-tube':
+                data = ('---\n' + self._stats_tube(args[0])).encode('ascii')
+            elif cmd == 'quit':
+                return
+            else:
+                reply = 'UNKNOWN_COMMAND'
+            if data is not None and cmd.startswith('stats'):
+                reply = 'OK %d' % (len(data),)
+            out = (reply + '\r\n').encode('ascii')
+            if data is not None:
+                out += data + b'\r\n'
+            sock.sendall(out)
+
+
+def serve(args):
+    """Mock server process: the virtual hosts, and the fake beanstalkd if asked"""
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    internet = MockInternet(set(load_names(args.names)), args.cert, args.key)
+    reuse_port = args.servers > 1
+    servers = [gevent.server.StreamServer(_listen(args.port, reuse_port),
+                                          internet.handle)]
+    if args.tls_port:
+        servers.append(gevent.server.StreamServer(_listen(args.tls_port, reuse_port),
+                                                  internet.handle_tls))
+    if args.beanstalk_port:
+        servers.append(gevent.server.StreamServer(_listen(args.beanstalk_port),
+                                                  FakeBeanstalkd().handle))
+    for server in servers:
+        server.start()
+    gevent.wait()
+
+
+def resolve_locally():
+    """Make every virtual host resolve to the loopback interface"""
+    getaddrinfo = socket.getaddrinfo
+
+    def _getaddrinfo(host, *args, **kwargs):
+        if host and host.endswith(DOMAIN_SUFFIX):
+            host = '127.0.0.1'
+        return getaddrinfo(host, *args, **kwargs)
+    socket.getaddrinfo = _getaddrinfo
+    # gevent's create_connection resolves without socket.getaddrinfo
+    create_connection = socket.create_connection
+
+    def _create_connection(address, *args, **kwargs):
+        if address[0] and address[0].endswith(DOMAIN_SUFFIX):
+            address = ('127.0.0.1',) + tuple(address[1:])
+        return create_connection(address, *args, **kwargs)
+    socket.create_connection = _create_connection
+
+
+class Benchmark(object):
+    """Runs the mock servers, then the hose and makework against them"""
+    __slots__ = ('args', 'hose_args', 'workdir', 'port', 'tls_port', 'beanstalk',
+                 'servers', 'cert', 'key', 'names_path', 'names')
+
+    def __init__(self, args, hose_args):
+        self.args = args
+        self.hose_args = hose_args
+        self.workdir = tempfile.mkdtemp(prefix='httphose-bench-')
+        self.port = _free_port()
+        self.tls_port = None
+        self.beanstalk = args.beanstalk
+        self.servers = []
+        self.cert = self.key = None
+        self.names_path, self.names = self._names()
+
+    def _path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def start(self):
+        if self.args.https:
+            self.cert, self.key = make_certificate(self.workdir)
+            if self.cert:
+                self.tls_port = _free_port()
+        beanstalk_port = None
+        if not self.beanstalk:
+            beanstalk_port = _free_port()
+            self.beanstalk = '127.0.0.1:%d' % (beanstalk_port,)
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([root] + env.get('PYTHONPATH', '').split(os.pathsep))
+        for idx in range(max(1, self.args.servers)):
+            cmd = [sys.executable, '-m', 'httphose.bench', '--serve', '-n', self.names_path,
+                   '--port', str(self.port), '--servers', str(self.args.servers)]
+            if self.cert:
+                cmd += ['--tls-port', str(self.tls_port),
+                        '--cert', self.cert, '--key', self.key]
+            if idx == 0 and beanstalk_port:
+                cmd += ['--beanstalk-port', str(beanstalk_port)]
+            self.servers.append(subprocess.Popen(cmd, env=env))
+        for port in (self.port, self.tls_port, beanstalk_port):
+            if port:
+                _wait_listening(port)
+        # Nothing may go through a proxy, the hosts are only resolved here
+        for name in ('http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY'):
+            os.environ.pop(name, None)
+        resolve_locally()
+
+    def stop(self):
+        """Stops the mock servers, returns their resource usage"""
+        usage = dict(cpu=0.0, maxrss_kb=0)
+        for proc in self.servers:
+            proc.terminate()
+            try:
+                _, _, rusage = os.wait4(proc.pid, 0)
+            except OSError as ex:
+                if ex.errno != errno.ECHILD:
+                    raise
+                continue
+            usage['cpu'] += rusage.ru_utime + rusage.ru_stime
+            usage['maxrss_kb'] = max(usage['maxrss_kb'], rusage.ru_maxrss)
+        self.servers = []
+        usage['cpu'] = round(usage['cpu'], 3)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        return usage
+
+    def _names(self):
+        path = self._path('names.txt')
+        if self.args.names:
+            names = load_names(self.args.names, self.args.names_count)
+        else:
+            with open(path, 'wb') as handle:
+                handle.write(pkg_resources.resource_string(__name__, 'common.txt'))
+            names = load_names(path, self.args.names_count)
+        names = [name for name in names if name not in END_GROUP] + END_GROUP
+        with open(path, 'w') as handle:
+            handle.write('\n'.join(names) + '\n')
+        return path, names
+
+    def _expected(self, hosts):
+        names = set(self.names)
+        return set([url + '/' + name for url, host, kind in hosts
+                    if kind in HIT_KINDS for name in names if is_hit(host, name, names)])
+
+    def _found(self, path):
+        found = set()
+        with open(path) as handle:
+            for line in handle:
+                if line.strip():
+                    found.add(unquote(json.loads(line)['url']))
+        return found
+
+    def _put_jobs(self, domains_path, tube):
+        """Put the domains onto beanstalk with makework, returns its numbers"""
+        argv = ['-b', self.beanstalk, '-d', domains_path, '--tube-fetch', tube]
+        options = parse_makework_args(make_makework_parser(), argv)
+        program = MakeWorkProgram(options)
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.time()
+        jobs = program.run()
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        program.channel.close()
+        return dict(elapsed=round(elapsed, 3), jobs=jobs,
+                    cpu=round(after.ru_utime + after.ru_stime -
+                              before.ru_utime - before.ru_stime, 3))
+
+    def _watch_tube(self, tube, main):
+        """Stop the hose, as Ctrl+C would, once the tube has no jobs left"""
+        import beanstalkc
+        host, port = self.beanstalk.split(':')
+        conn = beanstalkc.Connection(host=host, port=int(port))
+        while True:
+            gevent.sleep(0.5)
+            stats = conn.stats_tube(tube)
+            if not stats['current-jobs-ready'] and not stats['current-jobs-reserved']:
+                break
+        conn.close()
+        gevent.get_hub().loop.run_callback(main.throw, KeyboardInterrupt)
+
+    def makework(self):
+        try:
+            import_module('beanstalkc')
+        except ImportError:
+            LOG.warning("beanstalkc isn't installed, skipping the makework benchmark")
+            return None
+        path = self._path('makework.txt')
+        with open(path, 'w') as handle:
+            for idx in range(self.args.makework_domains):
+                handle.write('www.domain%d.example%d.test\n' % (idx, idx % 1000))
+        result = self._put_jobs(path, 'httphose_bench_makework')
+        result['domains'] = self.args.makework_domains
+        result['domains_per_sec'] = round(result['domains'] / max(result['elapsed'], 1e-6), 1)
+        return result
+
+    def hose(self):
+        hosts = make_hosts(self.args.hosts, self.args.mix, self.args.https,
+                           self.args.seed, self.port, self.tls_port)
+        domains_path = self._path('domains.txt')
+        with open(domains_path, 'w') as handle:
+            handle.write('\n'.join([url for url, _, _ in hosts]) + '\n')
+        output_path = self._path('results.json')
+        argv = ['-q', '--no-dns', '-n', self.names_path, '-o', output_path]
+        jobs = None
+        if self.args.via_beanstalk:
+            try:
+                import_module('beanstalkc')
+            except ImportError:
+                LOG.error("beanstalkc isn't installed, can't run --via-beanstalk")
+                return None
+            tube = 'httphose_bench_jobs'
+            jobs = self._put_jobs(domains_path, tube)
+            argv += ['-b', self.beanstalk, '--tube-fetch', tube,
+                     '--tube-resp', 'httphose_bench_resp']
+        else:
+            argv += ['-d', domains_path]
+        options = parse_hose_args(make_hose_parser(), argv + self.hose_args)
+        if options.workers > 1:
+            from .shards import ShardedHose
+            program = ShardedHose(options)
+        else:
+            program = HTTPHose(options)
+        watcher = gevent.spawn(self._watch_tube, tube, gevent.getcurrent()) if jobs else None
+
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        program.run()
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if watcher is not None:
+            watcher.kill()
+        options.output.close()
+
+        snapshot = program.metrics.snapshot()
+        ttfb = snapshot['latency']['ttfb']
+        cpu = (after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime +
+               after_children.ru_utime + after_children.ru_stime -
+               before_children.ru_utime - before_children.ru_stime)
+        expected = self._expected(hosts)
+        found = self._found(output_path)
+        return dict(
+            hosts=len(hosts), names=len(self.names),
+            probes=program.finished, requests=snapshot['counters']['requests'],
+            elapsed=round(elapsed, 3),
+            probes_per_sec=round(program.finished / max(elapsed, 1e-6), 1),
+            requests_per_sec=round(snapshot['counters']['requests'] / max(elapsed, 1e-6), 1),
+            ttfb_p50=_quantile(ttfb, 0.5), ttfb_p99=_quantile(ttfb, 0.99),
+            cpu=round(cpu, 3), cpu_percent=round(100 * cpu / max(elapsed, 1e-6), 1),
+            maxrss_kb=max(after.ru_maxrss, after_children.ru_maxrss),
+            errors=snapshot['errors'], suppressed=snapshot['counters']['suppressed'],
+            skipped=snapshot['counters']['skipped'],
+            expected=len(expected), found=len(found & expected),
+            missing=sorted(expected - found)[:10], missing_count=len(expected - found),
+            unexpected=sorted(found - expected)[:10], unexpected_count=len(found - expected),
+            makework=jobs)
+
+
+def _ms(value):
+    return '-' if value is None else '%.1fms' % (value * 1000,)
+
+
+def report(results):
+    hose = results.get('hose')
+    if hose:
+        print("hose: %d hosts x %d names, %d probes, %d requests in %.1fs" % (
+            hose['hosts'], hose['names'], hose['probes'], hose['requests'], hose['elapsed']))
+        print("  probes/s     %10.1f" % (hose['probes_per_sec'],))
+        print("  requests/s   %10.1f" % (hose['requests_per_sec'],))
+        print("  ttfb p50/p99 %10s / %s" % (_ms(hose['ttfb_p50']), _ms(hose['ttfb_p99'])))
+        print("  cpu          %10.1fs (%.0f%%)" % (hose['cpu'], hose['cpu_percent']))
+        print("  peak rss     %10.1f MB" % (hose['maxrss_kb'] / 1024.0,))
+        print("  errors       %s" % (', '.join(['%s=%d' % item for item in
+                                                sorted(hose['errors'].items()) if item[1]]) or '-',))
+        print("  hits         %d of %d expected, %d unexpected, %d soft 404s suppressed" % (
+            hose['found'], hose['expected'], hose['unexpected_count'], hose['suppressed']))
+        print("  skipped      %d names below missing directories" % (hose['skipped'],))
+        for url in hose['missing']:
+            print("    missing    %s" % (url,))
+        for url in hose['unexpected']:
+            print("    unexpected %s" % (url,))
+    makework = results.get('makework')
+    if makework:
+        print("makework: %d domains into %d jobs in %.2fs, %.0f domains/s, cpu %.2fs" % (
+            makework['domains'], makework['jobs'], makework['elapsed'],
+            makework['domains_per_sec'], makework['cpu']))
+    mock = results.get('mock')
+    if mock:
+        print("mock servers: cpu %.1fs, peak rss %.1f MB" % (
+            mock['cpu'], mock['maxrss_kb'] / 1024.0))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark httphose against a mock internet, arguments after -- go to the hose')
+    parser.add_argument('-v', '--verbose', action='store_const',
+                        dest="loglevel", const=logging.INFO,
+                        help="Log informational messages")
+    parser.add_argument('--debug', action='store_const', dest="loglevel",
+                        const=logging.DEBUG, default=logging.WARNING,
+                        help="Log debugging messages")
+    parser.add_argument('--hosts', default=50, type=int, metavar='N',
+                        help="Virtual hosts to probe, default: 50")
+    parser.add_argument('--mix', default=DEFAULT_MIX, metavar='KIND=WEIGHT,...',
+                        help="Proportions of each kind of host (%s), default: %s" % (
+                            ', '.join(KINDS), DEFAULT_MIX))
+    parser.add_argument('--https', default=20, type=int, metavar='PERCENT',
+                        help="Percentage of hosts served over HTTPS, default: 20")
+    parser.add_argument('-n', '--names', metavar='NAMES_FILE',
+                        help="Names to probe, default: the built-in list")
+    parser.add_argument('--names-count', default=200, type=int, metavar='N',
+                        help="Probe only the first N names, 0 for all, default: 200")
+    parser.add_argument('--seed', default=1, type=int,
+                        help="Seed for the mix of hosts, default: 1")
+    parser.add_argument('--servers', default=1, type=int, metavar='N',
+                        help="Mock server processes, default: 1")
+    parser.add_argument('-b', '--beanstalk', metavar='HOST:PORT',
+                        help="Use this beanstalkd rather than the fake one")
+    parser.add_argument('--via-beanstalk', action='store_true',
+                        help="Feed the hose its domains as beanstalk jobs")
+    parser.add_argument('--makework-domains', default=100000, type=int, metavar='N',
+                        help="Domains for the makework benchmark, 0 to skip, default: 100000")
+    parser.add_argument('--no-hose', action='store_false', dest='hose',
+                        help="Skip the hose benchmark")
+    parser.add_argument('--json', metavar='FILE', type=argparse.FileType('a'),
+                        help="Append the results as JSON to file")
+    parser.add_argument('--no-check', action='store_false', dest='check',
+                        help="Don't fail when hits are missing or unexpected")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--tls-port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--beanstalk-port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--cert', help=argparse.SUPPRESS)
+    parser.add_argument('--key', help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    argv = sys.argv[1:]
+    hose_args = []
+    if '--' in argv:
+        idx = argv.index('--')
+        argv, hose_args = argv[:idx], argv[idx + 1:]
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+    if args.serve:
+        serve(args)
+        return 0
+
+    bench = Benchmark(args, hose_args)
+    results = dict(time=round(time.time(), 3), argv=sys.argv[1:])
+    bench.start()
+    try:
+        if args.hose:
+            results['hose'] = bench.hose()
+        if args.makework_domains:
+            results['makework'] = bench.makework()
+    finally:
+        results['mock'] = bench.stop()
+    report(results)
+    if args.json:
+        args.json.write(json.dumps(results) + "\n")
+        args.json.close()
+    hose = results.get('hose')
+    if args.check and hose and (hose['missing_count'] or hose['unexpected_count']):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
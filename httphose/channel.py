@@ -0,0 +1,357 @@
+from __future__ import absolute_import
+import json
+import time
+import zlib
+import logging
+
+import gevent
+import gevent.event
+import gevent.queue
+
+
+LOG = logging.getLogger(__name__)
+
+# Default beanstalkd max-job-size is 65535 bytes
+MAX_JOB_SIZE = 1024 * 63
+
+# Jobs reserved ahead of the ones being worked on
+DEFAULT_PREFETCH = 4
+
+# Seconds a reserve waits for a job, queued acknowledgements can wait as long
+RESERVE_TIMEOUT = 1
+
+# Time-to-run assumed when a job's can't be read
+DEFAULT_TTR = 120
+
+# Job bodies starting with this are gzip compressed
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Compressed job bodies are inflated this much at a time
+INFLATE_CHUNK = 1024 * 16
+
+# Room left in a compressed job for the final deflate block and gzip trailer
+GZIP_SLACK = 64
+
+
+def connect_beanstalk(host, binary=False):
+    """With `binary`, job bodies are read as bytes where the client would
+    decode them, beanstalkc3 does by default, which gzipped jobs can't be.
+    Puts on a binary connection have to be bytes"""
+    import beanstalkc
+    if ':' not in host:
+        host += ':11300'
+    host, port = host.split(':')
+    try:
+        if binary:
+            try:
+                return beanstalkc.Connection(host=host, port=int(port), encoding=None)
+            except TypeError:
+                # Clients without `encoding` leave bodies as they were read
+                pass
+        return beanstalkc.Connection(host=host, port=int(port))
+    except beanstalkc.SocketError:
+        LOG.exception("Cannot connect to Beanstalk server @ %r:%r", host, port)
+        raise
+
+
+def job_ttr(job):
+    """Seconds the job may be reserved for without being touched"""
+    try:
+        return max(1, int(job.stats()['ttr']))
+    except Exception:
+        LOG.debug("Job %r: failed to read TTR", job.jid, exc_info=True)
+        return DEFAULT_TTR
+
+
+def _inflate(body):
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for offset in range(0, len(body), INFLATE_CHUNK):
+        yield inflater.decompress(body[offset:offset + INFLATE_CHUNK])
+    yield inflater.flush()
+
+
+def iter_records(body):
+    """JSON records from a job body, one per line, gzipped bodies are
+    inflated and parsed a chunk at a time"""
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    chunks = _inflate(body) if body[:2] == GZIP_MAGIC else [body]
+    tail = b''
+    for chunk in chunks:
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+    if tail.strip():
+        yield json.loads(tail.decode('utf-8'))
+
+
+def iter_batches(body):
+    """(domains, extra) for each record of a job body. A record is a list
+    of domains, or a dict with `domains` and optionally `extra`. Raises
+    ValueError on the first invalid record"""
+    for data in iter_records(body):
+        if isinstance(data, list):
+            yield data, None
+            continue
+        if not isinstance(data, dict):
+            raise ValueError("bad record type: %r" % (type(data),))
+        # {'domains':[...], 'extra':{?}}
+        domain_list = data.get('domains')
+        extra = data.get('extra')
+        if not isinstance(domain_list, list):
+            raise ValueError("bad type for domains: %r" % (type(domain_list),))
+        if extra and not isinstance(extra, dict):
+            raise ValueError("bad type for extra: %r" % (type(extra),))
+        yield domain_list, extra
+
+
+def pack_jobs(records, compress=True, limit=MAX_JOB_SIZE):
+    """Job bodies of newline separated JSON records, as many records per
+    job as fit in `limit` bytes, gzipped if `compress`"""
+    parts = []
+    size = 0
+    packer = None
+    for record in records:
+        line = json.dumps(record).encode('utf-8') + b'\n'
+        if not compress:
+            if parts and size + len(line) > limit:
+                yield b''.join(parts)
+                parts = []
+                size = 0
+            parts.append(line)
+            size += len(line)
+            continue
+        # Deflate can grow incompressible input, so assume it doesn't shrink
+        if parts and size + len(line) + GZIP_SLACK > limit:
+            parts.append(packer.flush())
+            yield b''.join(parts)
+            parts = []
+            size = 0
+        if not parts:
+            packer = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        # Sync flush after each record so the job's size is known
+        parts.append(packer.compress(line))
+        parts.append(packer.flush(zlib.Z_SYNC_FLUSH))
+        size += len(parts[-1]) + len(parts[-2])
+    if parts:
+        if compress:
+            parts.append(packer.flush())
+        yield b''.join(parts)
+
+
+def pack_lines(lines, limit=MAX_JOB_SIZE):
+    """Job bodies of JSON encoded result rows, as many per job as fit, as
+    bytes so they can be put on any connection"""
+    bodies = []
+    body = []
+    body_len = 0
+    for line in lines:
+        line = line.encode('utf-8')
+        if body and body_len + len(line) + 1 > limit:
+            bodies.append(b"\n".join(body))
+            body = []
+            body_len = 0
+        body.append(line)
+        body_len += len(line) + 1
+    if body:
+        bodies.append(b"\n".join(body))
+    return bodies
+
+
+def send_ack(job, action):
+    """Delete, bury, touch or release a `ChannelJob`, on the connection
+    which reserved it. Failures are logged, returns whether it was sent"""
+    try:
+        getattr(job.job, action)()
+        return True
+    except Exception:
+        LOG.exception("Job %r: failed to %s", job.jid, action)
+        return False
+
+
+def touch_jobs(jobs, force=False):
+    """Keep jobs reserved while they take longer than their TTR"""
+    now = time.time()
+    for job in list(jobs.values()):
+        if force or now - job.touched > job.ttr / 2.0:
+            if send_ack(job, 'touch'):
+                job.touched = now
+
+
+def release_jobs(jobs):
+    """Jobs not finished go back to the queue for someone else"""
+    for job in list(jobs.values()):
+        send_ack(job, 'release')
+    jobs.clear()
+
+
+class ChannelJob(object):
+    """
+    A reserved job. It's deleted only once every domain from it has been
+    probed, so jobs in progress when the process dies go back to the queue.
+    """
+    __slots__ = ('channel', 'job', 'pending', 'generated', 'ttr', 'touched')
+
+    def __init__(self, channel, job, ttr):
+        self.channel = channel
+        self.job = job
+        self.pending = 0
+        self.generated = False
+        self.ttr = ttr
+        self.touched = time.time()
+
+    @property
+    def jid(self):
+        return self.job.jid
+
+    @property
+    def batches(self):
+        """(domains, extra) batches, parsed as they're iterated"""
+        return iter_batches(self.job.body)
+
+    def add(self):
+        """A domain from the job is being worked on"""
+        self.pending += 1
+
+    def done(self):
+        """A domain from the job is finished"""
+        self.pending -= 1
+        if not self.pending and self.generated:
+            self.channel.ack(self, 'delete')
+
+    def complete(self):
+        """Every domain from the job has been handed out"""
+        self.generated = True
+        if not self.pending:
+            self.channel.ack(self, 'delete')
+
+    def fail(self):
+        self.channel.ack(self, 'bury')
+
+
+class BeanstalkChannel(object):
+    """
+    Jobs are reserved ahead, up to `--prefetch`, by one greenlet which owns
+    the reading connection. Deletes, buries and touches have to be sent on
+    the connection which reserved the job, so rather than locking it they're
+    queued and sent by that greenlet between reserves. Results are put over
+    a pool of `--result-connections`.
+    """
+    __slots__ = ('options', 'reader', 'writers', 'jobs', 'acks', 'prefetched',
+                 'wakeup', 'greenlet', 'closing')
+
+    def __init__(self, options):
+        if not options.beanstalk:
+            raise RuntimeError("Not enough info to create beanstalk channel!")
+        self.options = options
+        self.reader = None
+        self.writers = gevent.queue.Queue()
+        for _ in range(max(1, getattr(options, 'result_connections', 1))):
+            conn = connect_beanstalk(options.beanstalk)
+            conn.use(options.tube_resp)
+            self.writers.put(conn)
+        self.jobs = dict()
+        self.acks = []
+        self.prefetched = gevent.queue.Queue(
+            max(1, getattr(options, 'prefetch', DEFAULT_PREFETCH)))
+        self.wakeup = gevent.event.Event()
+        self.greenlet = None
+        self.closing = False
+        LOG.info("Connected to beanstalk @ %r - fetch: %r - resp: %r",
+                 options.beanstalk, options.tube_fetch, options.tube_resp)
+
+    def _put(self, body):
+        conn = self.writers.get()
+        try:
+            return conn.put(body)
+        finally:
+            self.writers.put(conn)
+
+    def put(self, data):
+        return self._put(json.dumps(data))
+
+    def put_lines(self, lines):
+        """Put JSON encoded rows, as many per job as fit in MAX_JOB_SIZE,
+        jobs are put in parallel over the result connections"""
+        bodies = pack_lines(lines)
+        if len(bodies) == 1:
+            self._put(bodies[0])
+        else:
+            gevent.joinall([gevent.spawn(self._put, body) for body in bodies],
+                           raise_error=True)
+
+    def put_batches(self, batches, compress=True):
+        """Put dicts of `domains` and `extra`, packed into as few jobs as
+        possible, returns the number of jobs put"""
+        count = 0
+        for body in pack_jobs(batches, compress):
+            self._put(body)
+            count += 1
+        return count
+
+    def ack(self, job, action):
+        """Queue a delete or bury, to be sent by the reading greenlet"""
+        if self.jobs.pop(job.jid, None) is not None:
+            self.acks.append((job, action))
+            self.wakeup.set()
+
+    def _send_acks(self):
+        acks, self.acks = self.acks, []
+        for job, action in acks:
+            send_ack(job, action)
+
+    def _reserve(self, conn):
+        import beanstalkc
+        try:
+            job = conn.reserve(timeout=0 if self.acks else RESERVE_TIMEOUT)
+        except beanstalkc.DeadlineSoon:
+            touch_jobs(self.jobs, force=True)
+            return
+        if job is None:
+            return
+        job = ChannelJob(self, job, job_ttr(job))
+        self.jobs[job.jid] = job
+        self.prefetched.put(job)
+
+    def _read(self):
+        conn = self.reader
+        while not self.closing:
+            self._send_acks()
+            touch_jobs(self.jobs)
+            if self.prefetched.full():
+                self.wakeup.clear()
+                self.wakeup.wait(RESERVE_TIMEOUT)
+                continue
+            try:
+                self._reserve(conn)
+            except Exception:
+                LOG.exception("Failed to reserve job")
+                gevent.sleep(RESERVE_TIMEOUT)
+        self._send_acks()
+        release_jobs(self.jobs)
+
+    def start(self):
+        if self.greenlet is None:
+            self.reader = connect_beanstalk(self.options.beanstalk, binary=True)
+            self.reader.watch(self.options.tube_fetch)
+            self.greenlet = gevent.spawn(self._read)
+
+    def getall(self):
+        """Reserved jobs, forever"""
+        self.start()
+        while True:
+            job = self.prefetched.get()
+            self.wakeup.set()
+            yield job
+
+    def close(self):
+        if self.greenlet is not None:
+            self.closing = True
+            self.wakeup.set()
+            self.greenlet.join()
+            self.greenlet = None
+            self.reader.close()
+        while not self.writers.empty():
+            self.writers.get().close()
@@ -0,0 +1,158 @@
+from __future__ import absolute_import
+import logging
+
+import gevent
+
+from .metrics import Histogram
+
+
+LOG = logging.getLogger(__name__)
+
+# Responses meaning the host, or a proxy in front of it, wants us to slow down
+THROTTLE_STATUS = (429, 503)
+
+# Request errors which suggest the host is overloaded or dropping us
+BACKOFF_ERRORS = ('connect', 'timeout')
+
+# Per-host backoff: first delay and cap in seconds, consecutive failures
+# before the host is abandoned, and retries of a single name
+BACKOFF_BASE = 1.0
+MAX_BACKOFF = 60.0
+MAX_STRIKES = 5
+NAME_RETRIES = 3
+
+# Seconds between concurrency adjustments, and the fewest requests in an
+# interval worth adjusting on
+ADAPT_INTERVAL = 1.0
+MIN_SAMPLE = 20
+
+# Fraction of requests failing or throttled which is taken as congestion,
+# as is mean time-to-first-byte growing past this multiple of the best seen
+ERROR_THRESHOLD = 0.05
+LATENCY_FACTOR = 4.0
+
+# Multiplicative decrease, and additive increase as a fraction of the limit
+DECREASE = 0.7
+INCREASE = 0.05
+
+# Request timeout is this multiple of the p99 time-to-first-byte, no less
+# than MIN_TIMEOUT unless `--timeout` is lower still
+TIMEOUT_FACTOR = 3.0
+MIN_TIMEOUT = 0.5
+
+
+def retry_after(resp):
+    """Seconds from a Retry-After header, None if absent or an HTTP date"""
+    value = resp.headers.get('Retry-After')
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+    return None
+
+
+class Controller(object):
+    """
+    Adjusts global concurrency AIMD-style from the run's metrics: while the
+    pool is saturated the limit grows, doubling until the first sign of
+    congestion and additively after, and it's cut multiplicatively when
+    too many requests fail, are throttled, or latency climbs. The request
+    timeout follows the observed p99 time-to-first-byte, up to `--timeout`.
+    """
+    __slots__ = ('metrics', 'adaptive', 'minimum', 'maximum', 'limit',
+                 'timeout', 'max_timeout', 'slow_start', 'floor', 'last',
+                 'greenlet')
+
+    def __init__(self, options, metrics):
+        self.metrics = metrics
+        self.adaptive = options.adaptive
+        self.max_timeout = self.timeout = options.timeout
+        self.limit = options.concurrency
+        self.minimum = self.maximum = self.limit
+        if self.adaptive:
+            self.minimum = max(1, options.min_concurrency)
+            self.maximum = max(self.minimum,
+                               options.max_concurrency or options.concurrency * 10)
+            self.limit = min(max(self.limit, self.minimum), self.maximum)
+        self.slow_start = True
+        self.floor = None
+        self.last = None
+        self.greenlet = None
+
+    def _sample(self):
+        metrics = self.metrics
+        errors = sum([metrics.errors[name] for name in BACKOFF_ERRORS + ('tls',)])
+        ttfb = metrics.latency['ttfb']
+        return (metrics.counters['requests'], errors,
+                metrics.counters['throttled'], metrics.errors['timeout'],
+                list(ttfb.counts), ttfb.total)
+
+    def _adjust(self, busy):
+        sample = self._sample()
+        if self.last is None:
+            self.last = sample
+            return
+        requests = sample[0] - self.last[0]
+        if requests < MIN_SAMPLE:
+            return
+        failed = (sample[1] - self.last[1]) + (sample[2] - self.last[2])
+        timeouts = sample[3] - self.last[3]
+        window = Histogram()
+        window.counts = [now - then for now, then in zip(sample[4], self.last[4])]
+        window.count = sum(window.counts)
+        window.total = sample[5] - self.last[5]
+        self.last = sample
+
+        latency = None
+        if window.count:
+            latency = window.total / window.count
+            # The best latency drifts up slowly, so it can follow a network
+            # that gets slower without the limit collapsing
+            if self.floor is None or latency < self.floor:
+                self.floor = latency
+            else:
+                self.floor *= 1.01
+            p99 = window.quantile(0.99)
+            floor = min(MIN_TIMEOUT, self.max_timeout)
+            self.timeout = min(self.max_timeout, max(floor, p99 * TIMEOUT_FACTOR))
+        # Slow responses never show up in the latency, only as timeouts
+        if float(timeouts) / requests > ERROR_THRESHOLD:
+            self.timeout = min(self.max_timeout, self.timeout * 2)
+
+        limit = self.limit
+        if float(failed) / requests > ERROR_THRESHOLD or \
+                (latency and latency > self.floor * LATENCY_FACTOR):
+            self.slow_start = False
+            limit = int(limit * DECREASE)
+        elif busy >= self.limit * 0.9:
+            if self.slow_start:
+                limit *= 2
+            else:
+                limit += max(1, int(limit * INCREASE))
+        limit = min(max(limit, self.minimum), self.maximum)
+        if limit != self.limit:
+            LOG.debug("Concurrency %d -> %d (%d requests, %d failed, latency %s)",
+                      self.limit, limit, requests, failed, latency)
+            self.limit = limit
+
+    def _run(self, scheduler, pool):
+        while True:
+            gevent.sleep(ADAPT_INTERVAL)
+            try:
+                self._adjust(len(pool))
+            except Exception:
+                LOG.exception("Failed to adjust concurrency")
+            if scheduler.limit != self.limit:
+                scheduler.limit = self.limit
+                scheduler.wakeup.set()
+
+    def start(self, scheduler, pool):
+        scheduler.limit = self.limit
+        if self.adaptive and self.greenlet is None:
+            self.greenlet = gevent.spawn(self._run, scheduler, pool)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
@@ -0,0 +1,120 @@
+from __future__ import absolute_import
+import re
+import random
+import zlib
+from collections import OrderedDict
+
+
+# Bytes of each response body which are fingerprinted
+SAMPLE_SIZE = 1024 * 8
+
+# Body lengths within the same or adjacent bucket are considered similar
+LENGTH_BUCKET = 512
+
+# Maximum differing bits between two similar simhashes
+SIMHASH_DISTANCE = 6
+
+# Suffixes for baseline paths, catch-alls often vary by extension or by
+# file vs directory
+BASELINE_SUFFIXES = ('', '.html', '/', '.php')
+
+_TOKENS = re.compile(br'\w+')
+
+
+def baseline_names(count):
+    """Random paths which shouldn't exist on any host"""
+    names = []
+    for idx in range(count):
+        name = '%012x' % (random.getrandbits(48),)
+        names.append(name + BASELINE_SUFFIXES[idx % len(BASELINE_SUFFIXES)])
+    return names
+
+
+def simhash(data):
+    """64bit simhash of the word tokens in `data`"""
+    weights = [0] * 64
+    counts = dict()
+    for token in _TOKENS.findall(data):
+        counts[token] = counts.get(token, 0) + 1
+    for token, count in counts.items():
+        value = (zlib.crc32(token) & 0xFFFFFFFF) | \
+                ((zlib.crc32(token, 0x5bd1e995) & 0xFFFFFFFF) << 32)
+        for bit in range(64):
+            if value & (1 << bit):
+                weights[bit] += count
+            else:
+                weights[bit] -= count
+    result = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            result |= 1 << bit
+    return result
+
+
+def read_head(resp, size=SAMPLE_SIZE):
+    """Read the start of a streamed response body, the remainder can still
+    be read with `iter_content`"""
+    return resp.raw.read(size, decode_content=True) or b''
+
+
+def is_soft404(status, headers, head, name, baseline, exclude=None):
+    """Does the response look like the host's catch-all page, either by
+    containing the `exclude` text or matching a baseline fingerprint"""
+    if exclude and exclude.encode('utf-8') in head:
+        return True
+    if baseline:
+        found = Fingerprint(status, headers, head, name)
+        for other in baseline:
+            if found.matches(other):
+                return True
+    return False
+
+
+class Fingerprint(object):
+    """Cheap similarity key for a response: status, length and simhash.
+    Without a body sample, as for HEAD probes, only the exact length is
+    compared"""
+    __slots__ = ('status', 'length', 'bucket', 'simhash', 'sampled')
+
+    def __init__(self, status, headers, head, name):
+        self.sampled = bool(head)
+        # Pages often reflect the requested path, which would skew the hash
+        if name:
+            head = head.replace(name.encode('utf-8'), b'')
+        length = headers.get('Content-Length')
+        if not length or not length.isdigit():
+            length = len(head)
+        self.status = status
+        self.length = int(length)
+        self.bucket = self.length // LENGTH_BUCKET
+        self.simhash = simhash(head)
+
+    def matches(self, other):
+        if self.status != other.status:
+            return False
+        if not self.sampled or not other.sampled:
+            return self.length == other.length
+        if abs(self.bucket - other.bucket) > 1:
+            return False
+        return bin(self.simhash ^ other.simhash).count('1') <= SIMHASH_DISTANCE
+
+
+class FingerprintCache(object):
+    """Baseline fingerprints per host, least recently used are dropped"""
+    __slots__ = ('hosts', 'size')
+
+    def __init__(self, size=1024 * 10):
+        self.hosts = OrderedDict()
+        self.size = size
+
+    def get(self, host):
+        baseline = self.hosts.pop(host, None)
+        if baseline is not None:
+            self.hosts[host] = baseline
+        return baseline
+
+    def put(self, host, baseline):
+        self.hosts.pop(host, None)
+        self.hosts[host] = baseline
+        while len(self.hosts) > self.size:
+            self.hosts.popitem(last=False)
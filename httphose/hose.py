@@ -0,0 +1,762 @@
+from __future__ import absolute_import, print_function
+
+# The gevent engine needs the standard library patched before it's imported
+from . import patch
+patch()
+import gevent
+import gevent.pool
+import gevent.queue
+import gevent.event
+
+import time
+import signal
+import logging
+import random
+from hashlib import sha1
+from collections import deque
+import requests
+import progressbar
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
+from .inputs import load_domains
+from .channel import BeanstalkChannel
+from .transport import Transport, CappedBody, HTTP_USER_AGENTS, whole_file
+from .resolver import Resolver
+from .sink import ResultSink
+from .storage import ContentStore
+from .journal import Journal, MAX_NAMES
+from .metrics import Metrics, classify_error
+from .control import (Controller, retry_after, THROTTLE_STATUS, BACKOFF_ERRORS,
+                      BACKOFF_BASE, MAX_BACKOFF, MAX_STRIKES, NAME_RETRIES)
+from .fingerprint import (Fingerprint, FingerprintCache, baseline_names,
+                          read_head, is_soft404)
+from .paths import PathStats, PathPlan, MISSING_STATUS, is_requested
+from .names import NamesIndex
+from .index import ResultIndex, conditional_headers
+
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+LOG = logging.getLogger(__name__)
+
+
+def _digest_kind(digest):
+    """Stored content hash, or a hash of the body sample, or only status
+    and length: digests of different kinds can't tell if a hit changed"""
+    if not digest:
+        return None
+    return digest.split(':', 1)[0] if ':' in digest else 'id'
+
+
+class Worker(object):
+    """
+    Probes the names for one domain, one request at a time as handed out by
+    the `Scheduler`. Unless the domain's baseline is cached, a few random
+    nonexistent paths are probed first, hits resembling them are soft 404s.
+    Names follow the hose's `PathPlan`, those below a directory are held
+    until it's been probed, and skipped if it's missing. When the host
+    throttles or drops requests it's backed off, with fewer requests
+    in-flight and a growing delay, and the names retried. After
+    `--host-failures` connection failures in a row it's given up on. Hosts
+    answering over HTTP/2 are allowed `--h2-streams` requests in-flight.
+    Hits already in the result index are only asked for if they changed.
+    """
+    __slots__ = ('hose', 'domain', 'names', 'extra', 'url', 'headers',
+                 'probe_headers', 'pending', 'inflight', 'baseline',
+                 'calibration', 'calibrating', 'index', 'done', 'probed',
+                 'limit', 'resume_at', 'strikes', 'failures', 'retry',
+                 'retries', 'job', 'skip', 'held', 'queued', 'prefix', 'quoted',
+                 'streams', 'known')
+
+    def __init__(self, hose, domain, names, extra=None, index=None, job=None):
+        self.hose = hose
+        self.domain = domain
+        self.names = names
+        self.extra = extra
+        self.index = index
+        self.job = job
+        url = domain.strip('/')
+        if not url.startswith('http://') and not url.startswith('https://'):
+            url = 'http://' + url
+        self.url = url
+        # Probe URLs are the prefix and the name's quoted form
+        self.prefix = url + '/'
+        self.quoted = hose.names_index.quoted
+        self.known = hose.index.known(self.prefix) if hose.index else None
+        self.headers = {
+            'User-Agent': hose.options.agent or random.choice(HTTP_USER_AGENTS)
+        }
+        if hose.options.probe == 'range':
+            self.probe_headers = dict(self.headers)
+            self.probe_headers['Range'] = 'bytes=0-%d' % (hose.options.probe_bytes - 1,)
+        else:
+            self.probe_headers = self.headers
+        # Names done are tracked so interrupted domains can be resumed
+        self.done = None
+        self.skip = None
+        if hose.journal and index is not None:
+            self.done = set()
+            self.skip = hose.journal.done_names(index)
+        self.pending = iter(hose.plan.entries)
+        self.held = dict()
+        self.queued = deque()
+        self.inflight = 0
+        self.streams = None
+        self.probed = 0
+        self.limit = None
+        self.resume_at = 0
+        self.strikes = 0
+        self.failures = 0
+        self.retry = []
+        self.retries = dict()
+        self.baseline = hose.fingerprints.get(url)
+        if self.baseline is None and hose.options.baseline > 0:
+            self.baseline = []
+            self.calibration = baseline_names(hose.options.baseline)
+        else:
+            self.calibration = []
+        self.calibrating = len(self.calibration)
+
+    def ready(self):
+        """Names are only handed out once the baseline is complete, and not
+        while the host is backed off"""
+        if self.limit is not None and self.inflight >= self.limit:
+            return False
+        if self.resume_at and self.resume_at > time.time():
+            return False
+        return not self.calibrating or bool(self.calibration)
+
+    def take(self):
+        """Next name to probe, or None if there's none to hand out now"""
+        if self.calibration:
+            return self.calibration.pop()
+        if self.retry:
+            return self.retry.pop()
+        if self.queued:
+            return self.queued.popleft()
+        while self.pending is not None:
+            entry = next(self.pending, None)
+            if entry is None:
+                self.pending = None
+                break
+            name = self._enter(entry)
+            if name is not None:
+                return name
+        return None
+
+    def _skipped(self, name):
+        return self.skip is not None and self.hose.name_index.get(name) in self.skip
+
+    def _enter(self, entry):
+        """Name to probe for a plan entry, if any. The names of a group are
+        held until its directory has been probed"""
+        if not isinstance(entry, tuple):
+            return None if self._skipped(entry) else entry
+        directory, names = entry
+        names = [name for name in names if not self._skipped(name)]
+        if self._skipped(directory):
+            self.queued.extend(names)
+            return self.queued.popleft() if self.queued else None
+        if names:
+            self.held[directory] = names
+        elif directory in self.hose.plan.synthetic:
+            return None
+        return directory
+
+    def _open(self, directory, status=None):
+        """The directory was probed, its names are skipped if it's missing"""
+        names = self.held.pop(directory, None)
+        if not names:
+            return
+        if status in MISSING_STATUS:
+            self.hose.metrics.incr('skipped', len(names))
+        else:
+            self.queued.extend(names)
+
+    @property
+    def waiting(self):
+        """Names came back, or were released, after all were handed out"""
+        return bool(self.retry or self.queued)
+
+    @property
+    def exhausted(self):
+        return self.pending is None and not self.retry and not self.queued \
+            and not self.held and not self.inflight
+
+    def abandon(self):
+        """Give up on the names not yet probed"""
+        self.pending = None
+        self.retry = []
+        self.queued.clear()
+        self.held.clear()
+        self.calibrating -= len(self.calibration)
+        self.calibration = []
+
+    def _backoff(self, name, calibrating, delay=None):
+        """Slow down after the host throttled or dropped a request, returns
+        True if the name was queued to be retried"""
+        self.strikes += 1
+        if self.strikes > MAX_STRIKES:
+            if self.pending is not None or self.held or self.queued:
+                LOG.info("Giving up on %r after %d failures in a row",
+                         self.domain, self.strikes - 1)
+            self.abandon()
+            return False
+        self.limit = max(1, (self.limit or self.streams or
+                             self.hose.options.per_host) // 2)
+        if delay is None:
+            delay = BACKOFF_BASE * 2 ** (self.strikes - 1)
+        self.resume_at = max(self.resume_at, time.time() + min(delay, MAX_BACKOFF))
+        if calibrating:
+            return False
+        retries = self.retries.get(name, 0)
+        if retries >= NAME_RETRIES:
+            return False
+        self.retries[name] = retries + 1
+        self.retry.append(name)
+        return True
+
+    def _recover(self):
+        """The host answered normally, reopen it a request at a time"""
+        self.strikes = 0
+        self.failures = 0
+        if self.limit is not None:
+            self.limit += 1
+            if self.limit >= (self.streams or self.hose.options.per_host):
+                self.limit = None
+
+    def _read_head(self, resp):
+        if resp.request.method == 'HEAD':
+            return b''
+        start = time.time()
+        head = read_head(resp, self.hose.options.probe_bytes)
+        self.hose.metrics.observe('body', time.time() - start)
+        return head
+
+    def _calibrate(self, resp, name, name_url):
+        # Redirected elsewhere, it's not what a hit would look like
+        if resp.status_code >= 200 and resp.status_code < 300 and \
+                is_requested(resp.url, name_url):
+            head = self._read_head(resp)
+            self.baseline.append(Fingerprint(resp.status_code, resp.headers,
+                                             head, name))
+
+    def probe(self, name):
+        # Real names aren't handed out until calibration has finished
+        calibrating = self.calibrating > 0
+        retrying = False
+        try:
+            retrying = self._probe(name, calibrating)
+        finally:
+            if calibrating:
+                self.calibrating -= 1
+                if not self.calibrating:
+                    self.hose.fingerprints.put(self.url, self.baseline)
+            elif not retrying:
+                # Without an answer, the names below aren't skipped
+                self._open(name)
+                index = self.hose.name_index.get(name)
+                if index is not None:
+                    self.probed += 1
+                    self.hose.on_probe()
+                    if self.hose.stats:
+                        self.hose.stats.probed(name)
+                    if self.done is not None:
+                        self.done.add(index)
+
+    def _fetch(self, name_url, entry=None):
+        """Full GET of a hit found by a HEAD or Range probe, for storage"""
+        transport = self.hose.transport
+        headers = self.headers
+        if entry is not None:
+            headers = conditional_headers(headers, entry)
+        resp = transport.get(name_url, headers, self.hose.control.timeout)
+        try:
+            if resp.status_code == 304 and entry is not None:
+                self.hose.on_unchanged(name_url)
+            elif resp.status_code >= 200 and resp.status_code < 300:
+                self.hose.on_result(name_url, resp, self.extra, previous=entry)
+        finally:
+            transport.release(resp)
+
+    def _probe(self, name, calibrating):
+        """Returns True when the name is to be retried after a backoff"""
+        name_url = self.prefix + self.quoted.get(name, name)
+        options = self.hose.options
+        metrics = self.hose.metrics
+        transport = self.hose.transport
+        method = 'HEAD' if options.probe == 'head' else 'GET'
+        headers = self.probe_headers
+        entry = self.known.get(name_url) if self.known else None
+        if entry is not None:
+            headers = conditional_headers(headers, entry)
+        metrics.incr('requests')
+        start = time.time()
+        try:
+            resp = transport.get(name_url, headers,
+                                 self.hose.control.timeout, method)
+        except Exception as ex:
+            error = classify_error(ex)
+            metrics.error(error)
+            LOG.debug("Failed to request %r: %r", name_url, ex)
+            if error in BACKOFF_ERRORS:
+                self.failures += 1
+                if self.failures >= options.host_failures:
+                    if self.pending is not None or self.held or self.queued:
+                        LOG.info("Giving up on %r after %d failed requests in a row",
+                                 self.domain, self.failures)
+                    self.abandon()
+                    return False
+                return self._backoff(name, calibrating)
+            return False
+        metrics.observe('ttfb', time.time() - start)
+        metrics.response(resp.status_code)
+        if resp.status_code in THROTTLE_STATUS:
+            metrics.incr('throttled')
+            transport.release(resp)
+            return self._backoff(name, calibrating, retry_after(resp))
+        self._recover()
+        if self.streams is None and transport.multiplexed(resp):
+            self.streams = options.h2_streams
+        if name in self.held:
+            self._open(name, resp.status_code)
+        refetch = False
+        try:
+            if calibrating:
+                self._calibrate(resp, name, name_url)
+            elif name in self.hose.plan.synthetic:
+                pass
+            elif resp.status_code == 304 and entry is not None:
+                if self.hose.stats:
+                    self.hose.stats.hit(name)
+                self.hose.on_unchanged(name_url)
+            elif resp.status_code >= 200 and resp.status_code < 300:
+                if is_requested(resp.url, name_url):
+                    head = self._read_head(resp)
+                    if is_soft404(resp.status_code, resp.headers, head,
+                                  name, self.baseline, options.exclude):
+                        metrics.incr('suppressed')
+                    else:
+                        if self.hose.stats:
+                            self.hose.stats.hit(name)
+                        if self.hose.storage and options.probe != 'get':
+                            refetch = True
+                        else:
+                            self.hose.on_result(name_url, resp, self.extra, head,
+                                                entry)
+        except Exception:
+            LOG.exception("Failed to process %r", name_url)
+        finally:
+            transport.release(resp)
+        if refetch:
+            try:
+                self._fetch(name_url, entry)
+            except Exception:
+                LOG.exception("Failed to fetch %r", name_url)
+        return False
+
+    def finish(self):
+        if self.done is not None:
+            self.hose.journal.domain_done(self.index)
+            self.done = None
+        if self.job is not None:
+            self.job.done()
+            self.job = None
+        self.hose.on_finish(len(self.names) - self.probed)
+
+    def suspend(self):
+        """Record progress of a domain left unfinished when stopping"""
+        if self.done:
+            self.hose.journal.names_done(self.index, self.done)
+        self.done = None
+
+
+# Seconds the scheduler waits before checking backed off hosts again
+BACKOFF_POLL = 0.25
+
+
+class Scheduler(object):
+    """
+    Interleaves individual (domain, name) probes from many workers across one
+    pool, so each pool slot is one request and no domain ever has more than
+    `per_host` requests in-flight, or its `streams` over HTTP/2. Workers are
+    pulled from a bounded queue, at most `window` domains are active at once.
+    No more than `limit` requests run at once, which the `Controller` can
+    change while running.
+    """
+    __slots__ = ('pool', 'per_host', 'window', 'queue', 'wakeup', 'active',
+                 'limit')
+
+    def __init__(self, pool, per_host, window):
+        self.pool = pool
+        self.per_host = max(1, per_host)
+        self.window = max(1, window)
+        self.limit = pool.size
+        self.queue = gevent.queue.Queue(self.window)
+        self.wakeup = gevent.event.Event()
+        self.active = deque()
+
+    def _feed(self, workers):
+        try:
+            for worker in workers:
+                self.queue.put(worker)
+                self.wakeup.set()
+        except Exception:
+            LOG.exception("While generating work")
+        self.queue.put(StopIteration)
+        self.wakeup.set()
+
+    def _probe(self, worker, name):
+        try:
+            worker.probe(name)
+        finally:
+            worker.inflight -= 1
+            if worker.exhausted:
+                worker.finish()
+                # An abandoned worker can still be in the rotation
+                if worker in self.active:
+                    self.active.remove(worker)
+            elif worker.pending is None and worker.waiting and worker not in self.active:
+                # Dropped once all names were handed out, but some came back
+                self.active.append(worker)
+            self.wakeup.set()
+
+    def _spawn_next(self, active):
+        """Round-robin over active workers, spawning the first probe allowed.
+        Returns False when every active worker is at its in-flight limit"""
+        for _ in range(len(active)):
+            worker = active.popleft()
+            if worker.inflight >= (worker.streams or self.per_host) \
+                    or not worker.ready():
+                active.append(worker)
+                continue
+            name = worker.take()
+            if name is None:
+                # Remaining probes, if any, will finish the worker
+                if worker.exhausted:
+                    worker.finish()
+                return True
+            worker.inflight += 1
+            active.append(worker)
+            self.pool.spawn(self._probe, worker, name)
+            return True
+        return False
+
+    def run(self, workers):
+        feeder = gevent.spawn(self._feed, workers)
+        active = self.active
+        feeding = True
+        try:
+            # In-flight probes can put their workers back, with names to
+            # retry or released from a group, so wait for them too
+            while feeding or active or len(self.pool):
+                while feeding and len(active) < self.window:
+                    try:
+                        worker = self.queue.get(block=not active and not len(self.pool))
+                    except gevent.queue.Empty:
+                        break
+                    if worker is StopIteration:
+                        feeding = False
+                    else:
+                        active.append(worker)
+                if not active:
+                    if len(self.pool):
+                        self.wakeup.clear()
+                        self.wakeup.wait(BACKOFF_POLL)
+                    continue
+                self.pool.wait_available()
+                self.wakeup.clear()
+                if len(self.pool) >= self.limit or not self._spawn_next(active):
+                    # Backed off hosts become ready without a wakeup
+                    self.wakeup.wait(BACKOFF_POLL)
+        finally:
+            feeder.kill()
+
+
+class ChannelWorkGenerator(object):
+    __slots__ = ('hose', 'channel')
+
+    def __init__(self, hose, channel):
+        self.hose = hose
+        self.channel = channel
+
+    @property
+    def total(self):
+        return None
+
+    def getall(self):
+        """Fetch batches of jobs from beanstalk, each job is acknowledged
+        once all of its domains are finished"""
+        for job in self.channel.getall():
+            LOG.info("Processing job: %r", job.jid)
+            try:
+                for domain_list, extra in job.batches:
+                    for domain in domain_list:
+                        job.add()
+                        yield Worker(self.hose, domain, self.hose.names, extra,
+                                     job=job)
+            except ValueError as ex:
+                LOG.warning("Job %r: invalid, %s", job.jid, ex)
+                job.fail()
+                continue
+            except Exception:
+                LOG.exception("While generating work from job %r", job.jid)
+                job.fail()
+                continue
+            job.complete()
+
+class ListWorkGenerator(object):
+    __slots__ = ('hose', 'domains', 'names', 'total')
+
+    def __init__(self, hose):
+        self.hose = hose
+        self.domains = self.hose.domains
+        self.names = self.hose.names
+        if isinstance(self.domains, list):
+            self.total = len(self.domains) * len(self.names)
+        else:
+            self.total = None
+
+    def getall(self):
+        """Workers are created lazily, as the scheduler has room for them,
+        so streamed domains are only read as fast as they're probed"""
+        for index, domain in self.domains:
+            yield Worker(self.hose, domain, self.names, index=index)
+
+
+class HTTPHose(object):
+    __slots__ = ('options', 'domains', 'names', 'beanstalk', 'finished',
+                 'progress', 'transport', 'fingerprints', 'sink', 'storage',
+                 'journal', 'names_index', 'name_index', 'metrics', 'control',
+                 'stats', 'plan', 'index')
+
+    def __init__(self, options):
+        self.finished = 0
+        self.metrics = Metrics()
+        self._setup_options(options)
+        self.control = Controller(options, self.metrics)
+        self._setup_transport(options)
+        self.fingerprints = FingerprintCache()
+        self._setup_beanstalk(options)
+        self.sink = ResultSink(options, self.beanstalk)
+        self.storage = ContentStore(options.storage) if options.storage else None
+        self.index = ResultIndex(options.result_index) if options.result_index else None
+        self._setup_progress(options)
+        if options.beanstalk:
+            LOG.info("%d file names, attached to beanstalk C&C channel", len(self.names))
+        elif isinstance(self.domains, list):
+            LOG.info("%d file names, %d domains", len(self.names), len(self.domains))
+        else:
+            LOG.info("%d file names, streaming domains", len(self.names))
+
+    def valid(self):
+        if self.beanstalk:
+            return True
+        if isinstance(self.domains, list):
+            if not self.domains and self.journal and self.journal.done:
+                LOG.warning("Nothing left to do, every domain is done in journal %r",
+                            self.journal.path)
+                return True
+            return len(self.domains)
+        return True
+
+    def _setup_transport(self, options):
+        if options.backend == 'http2':
+            from .http2 import HTTP2Transport
+            self.transport = HTTP2Transport(options, self.metrics)
+        else:
+            self.transport = Transport(options, self.metrics)
+
+    def _setup_options(self, options):
+        self.options = options
+        names = options.names
+        if not isinstance(names, NamesIndex):
+            names = NamesIndex.load(names, getattr(options, 'names_cache', None))
+        self.names_index = names
+        self.names = names.names
+        self.name_index = names.index
+        self.journal = None
+        if options.journal:
+            if options.beanstalk:
+                LOG.warning("Journal ignored, beanstalk jobs can't be resumed")
+            elif len(self.names) > MAX_NAMES:
+                LOG.warning("Journal ignored, it can't record more than %d names",
+                            MAX_NAMES)
+            else:
+                self.journal = Journal(options.journal, options.resume)
+        skip = self.journal.is_done if self.journal else None
+        self.domains = load_domains(options, skip)
+        self.stats = PathStats(options.path_stats) if options.path_stats else None
+        self.plan = PathPlan(self.names, self.stats, options.dir_groups)
+
+    def _setup_beanstalk(self, options):
+        if options.beanstalk:
+            self.beanstalk = BeanstalkChannel(options)
+        else:
+            self.beanstalk = None
+
+    def _setup_progress(self, options):
+        if options.progress:
+            if self.beanstalk or not isinstance(self.domains, list):
+                # With Beanstalk C&C or streamed input we don't know how many...
+                self.progress = progressbar.ProgressBar(
+                    redirect_stdout=True,
+                    redirect_stderr=True,
+                    widgets=[
+                        'Total: ',
+                        progressbar.Counter(),
+                        ', ',
+                        progressbar.Timer()
+                    ])
+            else:
+                self.progress = progressbar.ProgressBar(
+                    redirect_stdout=True,
+                    redirect_stderr=True,
+                    widgets=[
+                        progressbar.Percentage(),
+                        progressbar.Bar(),
+                        ' (', progressbar.ETA(), ') ',
+                    ])
+        else:
+            self.progress = None
+
+    def on_result(self, url, resp, extra=None, head=None, previous=None):
+        """Output a hit, with the result index only if it's new, or changed
+        from `previous`, the index entry it was probed with"""
+        etag = resp.headers.get('ETag')
+        modified = resp.headers.get('Last-Modified')
+        if previous is not None and ((etag and etag == previous[0]) or
+                                     (modified and modified == previous[1])):
+            # The server ignored the conditional request
+            self.on_unchanged(url)
+            return
+        code, length = whole_file(resp.status_code, resp.headers)
+        status = dict(
+            url=resp.url or url,
+            hist=[(hist.status_code, hist.url) for hist in resp.history],
+            sc=code,
+            hds=[K for K in resp.headers],
+            cks=[C.name for C in resp.cookies],
+            hd={k: v for k, v in dict(
+                lm=resp.headers.get('Last-Modified'),
+                ct=resp.headers.get('Content-Type'),
+                cl=length,
+                sv=resp.headers.get('Server'),
+            ).items() if v}
+        )
+        if extra and isinstance(extra, dict):
+            status.update(extra)
+        # Save file to content addressable storage
+        if self.storage:
+            body = CappedBody(resp, head, self.options.max_body,
+                              self.options.body_timeout)
+            start = time.time()
+            status['id'] = self.storage.store(body)
+            self.metrics.observe('body', time.time() - start)
+            if body.truncated:
+                status['tr'] = 1
+        if self.index is not None:
+            digest = status.get('id')
+            if digest is None and head:
+                digest = 'head:' + sha1(head).hexdigest()
+            if digest is None:
+                # No body sample, as with HEAD probes
+                digest = 'meta:%d:%s' % (code, length or '')
+            if previous is not None:
+                if digest == previous[2]:
+                    self.on_unchanged(url)
+                    return
+                if _digest_kind(previous[2]) == _digest_kind(digest):
+                    status['ch'] = 1
+            self.index.put(url, etag, modified, digest)
+        self._log_result(status)
+
+    def on_unchanged(self, url):
+        """A hit from the result index found again, and not output"""
+        self.metrics.incr('unchanged')
+        self.index.touch(url)
+
+    def _log_result(self, status):
+        self.metrics.incr('hits')
+        if self.options.extra:
+            status.update(self.options.extra)
+        self.sink.put(status)
+
+    def on_probe(self, count=1):
+        """Progress is counted in (domain, name) probes"""
+        self.finished += count
+        if self.progress:
+            try:
+                self.progress.update(self.finished)
+            except Exception:
+                self.progress.update(progressbar.UnknownLength)
+
+    def on_finish(self, skipped=0):
+        """Domain finished, names which weren't probed count as progress"""
+        self.metrics.incr('domains')
+        if skipped:
+            self.on_probe(skipped)
+
+    def run(self):
+        if self.beanstalk:
+            generator = ChannelWorkGenerator(self, self.beanstalk)
+        else:
+            generator = ListWorkGenerator(self)
+
+        pool = gevent.pool.Pool(self.control.maximum)
+        scheduler = Scheduler(pool, self.options.per_host,
+                              self.options.hosts or self.control.maximum)
+        self.finished = 0
+        if self.progress:
+            self.progress.start(generator.total)
+
+        workers = generator.getall()
+        if self.options.dns:
+            workers = Resolver(self.options, self.metrics).filter(workers)
+
+        metrics = self.metrics
+        metrics.gauge('pool_size', lambda: pool.size)
+        metrics.gauge('pool_busy', lambda: len(pool))
+        metrics.gauge('concurrency_limit', lambda: scheduler.limit)
+        metrics.gauge('timeout_seconds', lambda: self.control.timeout)
+        metrics.gauge('hosts_active', lambda: len(scheduler.active))
+        metrics.gauge('hosts_queued', scheduler.queue.qsize)
+        metrics.gauge('results_queued', self.sink.queue.qsize)
+        metrics.start(self.options.metrics_port, self.options.metrics_file,
+                      self.options.metrics_interval)
+        self.transport.start()
+        self.sink.start()
+        self.control.start(scheduler, pool)
+        # SIGTERM stops the run as Ctrl+C does, recording what was done
+        terminate = gevent.signal_handler(signal.SIGTERM, gevent.kill,
+                                          gevent.getcurrent(), KeyboardInterrupt)
+        try:
+            try:
+                scheduler.run(workers)
+            except KeyboardInterrupt:
+                print("Interrupted... stopping")
+            self.control.stop()
+            pool.join()
+            for worker in scheduler.active:
+                if not worker.exhausted:
+                    worker.suspend()
+        finally:
+            # Even after a crash, keep what's been done and found so far
+            terminate.cancel()
+            self.control.stop()
+            pool.kill()
+            if self.journal:
+                self.journal.close()
+            self.transport.close()
+            if self.storage:
+                self.storage.close()
+            if self.index:
+                self.index.close()
+            if self.stats:
+                self.stats.save()
+            self.sink.close()
+            if self.beanstalk:
+                self.beanstalk.close()
+            metrics.stop(self.options.metrics_file)
+
+        if self.progress:
+            self.progress.finish()
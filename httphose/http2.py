@@ -0,0 +1,172 @@
+from __future__ import absolute_import
+import ssl
+import time
+import logging
+
+import requests
+
+from .transport import Transport
+
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from cookielib import DefaultCookiePolicy
+
+
+LOG = logging.getLogger(__name__)
+
+# Hosts remembered as not speaking HTTP/2, forgotten all at once past this
+MAX_HTTP1_HOSTS = 1024 * 100
+
+
+def _netloc(url):
+    return url.split('/', 3)[2]
+
+
+def _as_requests_error(ex):
+    """The requests exception for an httpx one, so errors are classified,
+    and hosts backed off, the same whichever transport sent the request"""
+    import httpx
+    if isinstance(ex, httpx.ConnectTimeout):
+        return requests.exceptions.ConnectTimeout(ex)
+    if isinstance(ex, httpx.TimeoutException):
+        return requests.exceptions.ReadTimeout(ex)
+    if isinstance(ex, httpx.TooManyRedirects):
+        return requests.exceptions.TooManyRedirects(ex)
+    if isinstance(ex, httpx.TransportError):
+        cause = ex
+        while cause is not None:
+            if isinstance(cause, ssl.SSLError):
+                return requests.exceptions.SSLError(ex)
+            cause = cause.__cause__ or cause.__context__
+        return requests.exceptions.ConnectionError(ex)
+    return ex
+
+
+class HTTP2Response(object):
+    """
+    A streamed httpx response with the parts of a requests response the
+    hose uses: status, final URL, history, headers, cookies, and the
+    decoded body through `raw.read()` and `iter_content()`.
+    """
+    __slots__ = ('resp', 'status_code', 'url', 'history', 'headers',
+                 'request', 'chunks', 'buffer')
+
+    def __init__(self, resp):
+        self.resp = resp
+        self.status_code = resp.status_code
+        self.url = str(resp.url)
+        self.history = [HTTP2Response(hist) for hist in resp.history]
+        self.headers = resp.headers
+        self.request = resp.request
+        self.chunks = None
+        self.buffer = b''
+
+    @property
+    def raw(self):
+        return self
+
+    @property
+    def cookies(self):
+        return self.resp.cookies.jar
+
+    @property
+    def http_version(self):
+        return self.resp.http_version
+
+    def _next_chunk(self):
+        if self.chunks is None:
+            self.chunks = self.resp.iter_bytes()
+        for chunk in self.chunks:
+            if chunk:
+                return chunk
+        return b''
+
+    def read(self, size, decode_content=True):
+        """Up to `size` bytes of the body, which is always decoded"""
+        while len(self.buffer) < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def iter_content(self, chunk_size=None):
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            yield data
+        while True:
+            chunk = self._next_chunk()
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.resp.close()
+
+
+class HTTP2Transport(Transport):
+    """
+    Sends HTTPS probes with httpx over HTTP/2, so every probe for a host is
+    a stream on one connection, one handshake rather than one per pooled
+    connection. Plain HTTP, and hosts which don't negotiate HTTP/2, go
+    through the requests transport.
+    """
+    __slots__ = ('client', 'http1', 'metrics')
+
+    def __init__(self, options, metrics=None):
+        import httpx
+        super(HTTP2Transport, self).__init__(options, metrics)
+        limits = httpx.Limits(max_connections=None,
+                              max_keepalive_connections=options.keepalive_hosts,
+                              keepalive_expiry=options.idle or None)
+        self.client = httpx.Client(http2=True, verify=False, limits=limits,
+                                   follow_redirects=True,
+                                   max_redirects=options.redirects)
+        self.client.cookies.jar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.http1 = set()
+        self.metrics = metrics
+
+    def _trace(self):
+        """Observes how long connecting and the TLS handshake took"""
+        observe = self.metrics.observe
+        started = []
+
+        def trace(event, info):
+            if event == 'connection.connect_tcp.started':
+                started.append(time.time())
+            elif event == 'connection.start_tls.complete' and started:
+                observe('connect', time.time() - started[0])
+        return trace
+
+    def get(self, url, headers, timeout, method='GET'):
+        if not url.startswith('https://') or _netloc(url) in self.http1:
+            return super(HTTP2Transport, self).get(url, headers, timeout, method)
+        extensions = dict(trace=self._trace()) if self.metrics else None
+        request = self.client.build_request(method, url, headers=headers,
+                                            timeout=timeout, extensions=extensions)
+        try:
+            resp = self.client.send(request, stream=True)
+        except Exception as ex:
+            raise _as_requests_error(ex)
+        if resp.http_version != 'HTTP/2':
+            if len(self.http1) >= MAX_HTTP1_HOSTS:
+                self.http1.clear()
+            self.http1.add(_netloc(url))
+        return HTTP2Response(resp)
+
+    def multiplexed(self, resp):
+        return isinstance(resp, HTTP2Response) and resp.http_version == 'HTTP/2'
+
+    def release(self, resp, limit=None):
+        """Resetting an HTTP/2 stream leaves the connection usable, so the
+        rest of the body is never drained"""
+        if isinstance(resp, HTTP2Response):
+            resp.close()
+        else:
+            super(HTTP2Transport, self).release(resp)
+
+    def close(self):
+        super(HTTP2Transport, self).close()
+        self.client.close()
@@ -0,0 +1,89 @@
+from __future__ import absolute_import
+import time
+import sqlite3
+import logging
+
+
+LOG = logging.getLogger(__name__)
+
+# Rows buffered before being written in one transaction
+FLUSH_ROWS = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    modified TEXT,
+    digest TEXT,
+    seen INTEGER
+)
+"""
+
+
+def conditional_headers(headers, entry):
+    """Headers asking for the URL only if it changed since `entry`"""
+    etag, modified, _ = entry
+    if not etag and not modified:
+        return headers
+    headers = dict(headers)
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    return headers
+
+
+class ResultIndex(object):
+    """
+    Hits from previous runs in a SQLite file, by the URL probed: their
+    ETag and Last-Modified, to probe them conditionally, and a digest of
+    the content, to tell whether it changed. Entries are (etag, modified,
+    digest) tuples. Writes are buffered and committed in batches, processes
+    with `--workers` share the file through SQLite's own locking.
+    """
+    __slots__ = ('path', 'db', 'rows', 'seen')
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(SCHEMA)
+        self.db.commit()
+        self.rows = []
+        self.seen = []
+
+    def known(self, prefix):
+        """Entries for every URL starting with `prefix`, by URL"""
+        cursor = self.db.execute(
+            'SELECT url, etag, modified, digest FROM results WHERE url >= ? AND url < ?',
+            (prefix, prefix + u'\uffff'))
+        return dict([(row[0], row[1:]) for row in cursor])
+
+    def put(self, url, etag, modified, digest):
+        self.rows.append((url, etag, modified, digest, int(time.time())))
+        if len(self.rows) >= FLUSH_ROWS:
+            self.flush()
+
+    def touch(self, url):
+        """The URL was found again, unchanged"""
+        self.seen.append((int(time.time()), url))
+        if len(self.seen) >= FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.rows and not self.seen:
+            return
+        with self.db:
+            if self.rows:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)', self.rows)
+            if self.seen:
+                self.db.executemany(
+                    'UPDATE results SET seen = ? WHERE url = ?', self.seen)
+        self.rows = []
+        self.seen = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
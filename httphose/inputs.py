@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+import random
+from itertools import chain
+
+
+DEFAULT_SHUFFLE_BUFFER = 1024 * 64
+
+
+def iter_lines(handle):
+    """Non-empty, stripped lines from a file, read lazily"""
+    for line in handle:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def shuffled(iterable, size=DEFAULT_SHUFFLE_BUFFER):
+    """
+    Approximate shuffle using a bounded buffer: each incoming item replaces
+    a random buffered item, which is emitted. Memory is limited to `size`
+    items, however large the input.
+    """
+    size = max(1, size)
+    buf = []
+    for item in iterable:
+        if len(buf) < size:
+            buf.append(item)
+            continue
+        idx = random.randrange(size)
+        yield buf[idx]
+        buf[idx] = item
+    random.shuffle(buf)
+    for item in buf:
+        yield item
+
+
+def _indexed(domains, skip):
+    for index, domain in enumerate(domains):
+        if skip is None or not skip(index):
+            yield index, domain
+
+
+def load_domains(options, skip=None):
+    """
+    (index, domain) pairs for the domains given on the command line and in
+    the --domains file, where index is the domain's position in the input,
+    and those for which `skip(index)` is true are left out. With --stream
+    the file is read lazily through a shuffle buffer, otherwise it is loaded
+    and shuffled in full so the total is known up-front.
+    """
+    domains = options.domain or []
+    if options.domains:
+        domains = chain(domains, iter_lines(options.domains))
+    domains = _indexed(domains, skip)
+    if getattr(options, 'stream', False) and options.domains:
+        return shuffled(domains, options.shuffle_buffer)
+    domains = list(domains)
+    random.shuffle(domains)
+    return domains
@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+import os
+import time
+import struct
+import logging
+
+
+LOG = logging.getLogger(__name__)
+
+NAME_BITS = 20
+NAME_MASK = (1 << NAME_BITS) - 1
+
+# Name index recorded when every name for a domain is done
+DOMAIN_DONE = NAME_MASK
+
+# Most names a journal can record, their indexes are below DOMAIN_DONE
+MAX_NAMES = DOMAIN_DONE
+
+RECORD_SIZE = 8
+
+# Records buffered before being appended to the journal, and the most
+# seconds they're buffered for
+FLUSH_RECORDS = 256
+FLUSH_INTERVAL = 1.0
+
+
+class Journal(object):
+    """
+    Append-only record of completed work, so an interrupted run can be
+    resumed. Each record is a little-endian uint64, holding the domain's
+    position in the input in the upper bits and a name index in the lower
+    20 bits. Finished domains are one DOMAIN_DONE record, names are only
+    recorded individually for domains in progress when the run stopped.
+    """
+    __slots__ = ('path', 'handle', 'buffer', 'flushed', 'done', 'partial')
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.buffer = []
+        self.flushed = time.time()
+        self.done = bytearray()
+        self.partial = dict()
+        if resume and os.path.exists(path):
+            self._load()
+            self.handle = open(path, 'ab')
+        else:
+            self.handle = open(path, 'wb')
+
+    def _load(self):
+        size = os.path.getsize(self.path)
+        # A crash can leave a partial record at the end
+        size -= size % RECORD_SIZE
+        records = 0
+        with open(self.path, 'r+b') as handle:
+            handle.truncate(size)
+            while True:
+                data = handle.read(RECORD_SIZE * 1024 * 128)
+                if not data:
+                    break
+                chunk = struct.unpack('<%dQ' % (len(data) // RECORD_SIZE,), data)
+                records += len(chunk)
+                for record in chunk:
+                    domain = record >> NAME_BITS
+                    name = record & NAME_MASK
+                    if name == DOMAIN_DONE:
+                        self._set_done(domain)
+                    else:
+                        self.partial.setdefault(domain, set()).add(name)
+        for domain in list(self.partial.keys()):
+            if self.is_done(domain):
+                del self.partial[domain]
+        LOG.info("Resuming from journal %r: %d records, %d partial domains",
+                 self.path, records, len(self.partial))
+
+    def _set_done(self, domain):
+        offset = domain >> 3
+        if offset >= len(self.done):
+            self.done.extend(bytearray(offset - len(self.done) + 1))
+        self.done[offset] |= 1 << (domain & 7)
+
+    def is_done(self, domain):
+        offset = domain >> 3
+        if offset >= len(self.done):
+            return False
+        return bool(self.done[offset] & (1 << (domain & 7)))
+
+    def done_names(self, domain):
+        """Indexes of names already probed for a partially done domain"""
+        return self.partial.get(domain)
+
+    def _added(self):
+        if len(self.buffer) >= FLUSH_RECORDS or \
+                time.time() - self.flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    def domain_done(self, domain):
+        self.buffer.append((domain << NAME_BITS) | DOMAIN_DONE)
+        self._added()
+
+    def names_done(self, domain, names):
+        for name in names:
+            self.buffer.append((domain << NAME_BITS) | name)
+        self._added()
+
+    def flush(self):
+        self.flushed = time.time()
+        if not self.buffer:
+            return
+        self.handle.write(struct.pack('<%dQ' % (len(self.buffer),), *self.buffer))
+        self.handle.flush()
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.handle.close()
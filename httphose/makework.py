@@ -2,9 +2,14 @@ from __future__ import absolute_import, print_function
 import sys
 import argparse
 import logging
-import json
-import random
-from . import BeanstalkChannel
+from .channel import BeanstalkChannel
+from .inputs import load_domains, DEFAULT_SHUFFLE_BUFFER
+
+
+LOG = logging.getLogger(__name__)
+
+# Bytes of URLs in each batch, many batches are packed into one job
+BATCH_SIZE = 1024 * 8
 
 
 class MakeWorkProgram(object):
@@ -13,43 +18,45 @@ class MakeWorkProgram(object):
     def __init__(self, options):
         self.options = options
         self.channel = BeanstalkChannel(options) if options.beanstalk else None
-        self.domains = options.domain
-        if options.domains:
-            self.domains += filter(None, options.domains.read().split("\n"))
-        random.shuffle(self.domains)
+        self.domains = load_domains(options)
 
     def valid(self):
-        return len(self.domains)
+        if isinstance(self.domains, list):
+            return len(self.domains)
+        return True
 
-    def _output_batch(self, batch):
-        if self.channel:
-            self.channel.put(batch)
+    def _batch(self, urls):
+        batch = dict(domains=urls)
+        if self.options.extra:
+            batch['extra'] = self.options.extra
+        return batch
 
-    def run(self):
+    def _batches(self):
+        """Dicts of `domains` and `extra`, each about BATCH_SIZE bytes of URLs"""
         batch = []
         batch_len = 0
-        max_bytes = 1024*32
-        batch_data = dict()
-        if self.options.extra:
-            batch_data['extra'] = self.options.extra
-
-        for domain in self.domains:
+        for _, domain in self.domains:
             url = domain.strip('/')
             if not url.startswith('http:') and not url.startswith('https:'):
                 url = 'http://' + url
             batch_len += len(url)
             batch.append(url)
-            if batch_len > max_bytes:
-                batch_data['domains'] = batch
-                self._output_batch(batch_data)
+            if batch_len > BATCH_SIZE:
+                yield self._batch(batch)
                 batch = []
                 batch_len = 0
         if len(batch):
-            batch_data['domains'] = batch
-            self._output_batch(batch_data)
+            yield self._batch(batch)
 
+    def run(self):
+        if not self.channel:
+            return
+        jobs = self.channel.put_batches(self._batches(), self.options.compress)
+        LOG.info("Put %d jobs", jobs)
+        return jobs
 
-def main():
+
+def make_parser():
     parser = argparse.ArgumentParser(description='Work generator for httphose')
     parser.add_argument('-v', '--verbose', action='store_const',
                         dest="loglevel", const=logging.INFO,
@@ -65,20 +72,37 @@ def main():
                         help='Beanstalk tube to respond to, default: httphose_resp')
     parser.add_argument('-x', '--extra', metavar='K=V', action='append',
                         help="Extra variables for JSON output")
+    parser.add_argument('--no-compress', action='store_false', dest='compress',
+                        help="Don't gzip job bodies, for consumers which can't read them")
     parser.add_argument('-d', '--domains', metavar='DOMAINS_FILE',
                         type=argparse.FileType('r'),
-                        help="Load target domains from file")
+                        help="Load target domains from file, - for stdin")
+    parser.add_argument('-S', '--stream', action='store_true',
+                        help="Read domains lazily instead of loading the whole file")
+    parser.add_argument('--shuffle-buffer', default=DEFAULT_SHUFFLE_BUFFER,
+                        type=int, metavar='N',
+                        help="Domains buffered to shuffle streamed input, default: %d" % (
+                            DEFAULT_SHUFFLE_BUFFER,))
     parser.add_argument('domain', nargs='*', help='One or more domains')
-    args = parser.parse_args()
+    return parser
+
+
+def parse_args(parser, argv=None):
+    args = parser.parse_args(argv)
 
     # XXX: job tubes are switched, here we put into fetch, and ignore resp
     tmp = args.tube_resp
     args.tube_resp = args.tube_fetch
     args.tube_fetch = tmp
 
-    logging.basicConfig(level=args.loglevel)
-
     args.extra = dict([X.split('=', 1) for X in args.extra or []])
+    return args
+
+
+def main():
+    parser = make_parser()
+    args = parse_args(parser)
+    logging.basicConfig(level=args.loglevel)
 
     program = MakeWorkProgram(args)
     if not program.valid():
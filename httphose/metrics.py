@@ -0,0 +1,260 @@
+from __future__ import absolute_import
+import json
+import time
+import socket
+import logging
+
+import gevent
+import requests
+
+
+LOG = logging.getLogger(__name__)
+
+ERROR_CLASSES = ('dns', 'connect', 'tls', 'timeout', 'http', 'other')
+
+PHASES = ('connect', 'ttfb', 'body')
+
+# Upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+
+def _causes(exc):
+    """The exception and those it wraps, requests and urllib3 nest them"""
+    seen = 0
+    while exc is not None and seen < 8:
+        yield exc
+        seen += 1
+        inner = getattr(exc, 'reason', None)
+        if inner is None and exc.args and isinstance(exc.args[0], Exception):
+            inner = exc.args[0]
+        if inner is None:
+            inner = getattr(exc, '__cause__', None) or getattr(exc, '__context__', None)
+        exc = inner if isinstance(inner, BaseException) else None
+
+
+def classify_error(exc):
+    """Error class for a failed request, one of ERROR_CLASSES"""
+    if isinstance(exc, requests.exceptions.Timeout):
+        return 'timeout'
+    if isinstance(exc, requests.exceptions.SSLError):
+        return 'tls'
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        for cause in _causes(exc):
+            if isinstance(cause, socket.gaierror) or \
+                    type(cause).__name__ == 'NameResolutionError':
+                return 'dns'
+            if isinstance(cause, socket.timeout):
+                return 'timeout'
+        return 'connect'
+    if isinstance(exc, (requests.exceptions.TooManyRedirects,
+                        requests.exceptions.HTTPError)):
+        return 'http'
+    return 'other'
+
+
+class Histogram(object):
+    """Fixed bucket latency histogram, as used by Prometheus"""
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        idx = 0
+        for bound in LATENCY_BUCKETS:
+            if value <= bound:
+                break
+            idx += 1
+        self.counts[idx] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """Approximate quantile, the upper bound of the bucket it's in"""
+        if not self.count:
+            return None
+        wanted = self.count * fraction
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                if idx < len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[idx]
+                break
+        return float('inf')
+
+    def snapshot(self):
+        return dict(count=self.count, sum=round(self.total, 6),
+                    buckets=list(self.counts),
+                    p50=self.quantile(0.5), p99=self.quantile(0.99))
+
+    def add(self, snapshot):
+        """Add the observations from another histogram's snapshot"""
+        for idx, count in enumerate(snapshot['buckets']):
+            self.counts[idx] += count
+        self.total += snapshot['sum']
+        self.count += snapshot['count']
+
+
+class Metrics(object):
+    """
+    Run-time counters, per-phase latency histograms and gauges, exposed as
+    periodic JSON snapshots and as Prometheus text over HTTP.
+    """
+    __slots__ = ('started', 'counters', 'errors', 'status', 'latency',
+                 'gauges', 'last', 'greenlets', 'server', 'children')
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = dict(requests=0, hits=0, domains=0, suppressed=0,
+                             throttled=0, skipped=0, unchanged=0)
+        self.errors = dict([(name, 0) for name in ERROR_CLASSES])
+        self.status = dict()
+        self.latency = dict([(name, Histogram()) for name in PHASES])
+        self.gauges = dict()
+        self.last = (self.started, dict(self.counters))
+        self.greenlets = []
+        self.server = None
+        self.children = dict()
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def error(self, exc_or_class):
+        if isinstance(exc_or_class, BaseException):
+            exc_or_class = classify_error(exc_or_class)
+        self.errors[exc_or_class] += 1
+
+    def response(self, status_code):
+        key = '%dxx' % (status_code // 100,)
+        self.status[key] = self.status.get(key, 0) + 1
+        if status_code >= 500:
+            self.errors['http'] += 1
+
+    def observe(self, phase, seconds):
+        self.latency[phase].observe(seconds)
+
+    def gauge(self, name, func):
+        """Register a function returning the gauge's current value"""
+        self.gauges[name] = func
+
+    def absorb(self, source, snapshot):
+        """Include the latest snapshot from another process in the totals"""
+        self.children[source] = snapshot
+
+    def _gauge_values(self):
+        values = dict()
+        for name, func in self.gauges.items():
+            try:
+                values[name] = func()
+            except Exception:
+                LOG.debug("Failed to read gauge %r", name, exc_info=True)
+        return values
+
+    def _totals(self):
+        """Counters, errors, status, latency and gauges of this process
+        summed with those absorbed from others"""
+        counters = dict(self.counters)
+        errors = dict(self.errors)
+        status = dict(self.status)
+        latency = dict()
+        for name, hist in self.latency.items():
+            latency[name] = Histogram()
+            latency[name].add(hist.snapshot())
+        gauges = self._gauge_values()
+        for child in self.children.values():
+            for total, values in ((counters, child['counters']),
+                                  (errors, child['errors']),
+                                  (status, child['status']),
+                                  (gauges, child['gauges'])):
+                for name, value in values.items():
+                    total[name] = total.get(name, 0) + value
+            for name, hist in child['latency'].items():
+                latency[name].add(hist)
+        return counters, errors, status, latency, gauges
+
+    def snapshot(self):
+        now = time.time()
+        counters, errors, status, latency, gauges = self._totals()
+        last_time, last_counters = self.last
+        elapsed = max(now - last_time, 1e-6)
+        rates = dict([(name + '_per_sec',
+                       round((value - last_counters.get(name, 0)) / elapsed, 3))
+                      for name, value in counters.items()])
+        self.last = (now, counters)
+        return dict(
+            time=round(now, 3),
+            uptime=round(now - self.started, 3),
+            counters=counters,
+            rates=rates,
+            errors=errors,
+            status=status,
+            latency=dict([(name, hist.snapshot())
+                          for name, hist in latency.items()]),
+            gauges=gauges,
+        )
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        counters, errors, status, latency, gauges = self._totals()
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines.append('# TYPE httphose_%s_total counter' % (name,))
+            lines.append('httphose_%s_total %d' % (name, value))
+        lines.append('# TYPE httphose_errors_total counter')
+        for name, value in sorted(errors.items()):
+            lines.append('httphose_errors_total{class="%s"} %d' % (name, value))
+        lines.append('# TYPE httphose_responses_total counter')
+        for name, value in sorted(status.items()):
+            lines.append('httphose_responses_total{status="%s"} %d' % (name, value))
+        lines.append('# TYPE httphose_latency_seconds histogram')
+        for phase, hist in sorted(latency.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, hist.counts):
+                cumulative += count
+                lines.append('httphose_latency_seconds_bucket{phase="%s",le="%g"} %d' % (
+                    phase, bound, cumulative))
+            lines.append('httphose_latency_seconds_bucket{phase="%s",le="+Inf"} %d' % (
+                phase, hist.count))
+            lines.append('httphose_latency_seconds_sum{phase="%s"} %f' % (phase, hist.total))
+            lines.append('httphose_latency_seconds_count{phase="%s"} %d' % (phase, hist.count))
+        for name, value in sorted(gauges.items()):
+            lines.append('# TYPE httphose_%s gauge' % (name,))
+            lines.append('httphose_%s %s' % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def _wsgi(self, environ, start_response):
+        body = self.prometheus().encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    def _write_snapshots(self, handle, interval):
+        while True:
+            gevent.sleep(interval)
+            handle.write(json.dumps(self.snapshot()) + "\n")
+            handle.flush()
+
+    def start(self, port=None, handle=None, interval=10):
+        if port:
+            from gevent.pywsgi import WSGIServer
+            self.server = WSGIServer(('127.0.0.1', port), self._wsgi, log=None)
+            self.server.start()
+            LOG.info("Serving metrics on http://127.0.0.1:%d/", port)
+        if handle:
+            self.greenlets.append(gevent.spawn(self._write_snapshots,
+                                               handle, interval))
+
+    def stop(self, handle=None):
+        for greenlet in self.greenlets:
+            greenlet.kill()
+        self.greenlets = []
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        if handle:
+            handle.write(json.dumps(self.snapshot()) + "\n")
+            handle.flush()
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+import os
+import re
+import sys
+import marshal
+import logging
+from hashlib import sha1
+
+from requests.utils import requote_uri
+
+
+LOG = logging.getLogger(__name__)
+
+# Bump when the compiled format changes, so old caches are ignored
+CACHE_VERSION = 1
+
+# Names of only these characters are the same quoted
+_PLAIN = re.compile(r'^[A-Za-z0-9._~/-]*$')
+
+
+def quote_name(name):
+    return name if _PLAIN.match(name) else requote_uri(name)
+
+
+def _normalise(line):
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', 'replace')
+    name = line.strip()
+    if not name or name[0] == '#':
+        return None
+    # Names are relative to the domain's URL, which already ends in a slash
+    return name.lstrip('/') or None
+
+
+class NamesIndex(object):
+    """
+    The names to probe, stripped of comments, blanks and duplicates, each
+    with its position for the journal and its URL-quoted form, quoted as
+    requests would so URLs built from it are sent as they are. A compiled
+    index can be cached, keyed on a hash of the names file.
+    """
+    __slots__ = ('names', 'index', 'quoted', 'duplicates')
+
+    def __init__(self, names, quoted=None, duplicates=0):
+        self.names = names
+        self.index = dict(zip(names, range(len(names))))
+        if quoted is None:
+            quoted = [quote_name(name) for name in names]
+        self.quoted = dict(zip(names, quoted))
+        self.duplicates = duplicates
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_lines(cls, lines):
+        names = []
+        seen = set()
+        duplicates = 0
+        for line in lines:
+            name = _normalise(line)
+            if name is None:
+                continue
+            if name in seen:
+                duplicates += 1
+                continue
+            seen.add(name)
+            names.append(name)
+        if duplicates:
+            LOG.info("Dropped %d duplicate names", duplicates)
+        return cls(names, duplicates=duplicates)
+
+    @classmethod
+    def load(cls, handle, cache_dir=None):
+        """Index of the names in an open file, from the cache if it has been
+        compiled before"""
+        if not cache_dir:
+            return cls.from_lines(handle)
+        data = handle.read()
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        key = sha1(data)
+        key.update(('%d:%d:%d' % (CACHE_VERSION, sys.version_info[0],
+                                   marshal.version)).encode('ascii'))
+        path = os.path.join(cache_dir, 'names-%s.bin' % (key.hexdigest(),))
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as cached:
+                    names, quoted = marshal.loads(cached.read())
+                LOG.debug("Loaded %d names from cache %r", len(names), path)
+                return cls(names, quoted)
+            except (EOFError, ValueError, TypeError):
+                LOG.warning("Ignoring unreadable names cache %r", path)
+        index = cls.from_lines(data.splitlines())
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as cached:
+            cached.write(marshal.dumps((index.names, [index.quoted[name]
+                                                      for name in index.names])))
+        os.rename(tmp, path)
+        return index
@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+import os
+import json
+import logging
+
+try:
+    from urllib.parse import urlsplit, unquote
+except ImportError:
+    from urlparse import urlsplit
+    from urllib import unquote
+
+
+LOG = logging.getLogger(__name__)
+
+# Names under a directory which are worth probing the directory for first
+MIN_GROUP = 2
+
+# Statuses meaning the directory isn't there, so neither is anything below it
+MISSING_STATUS = (404, 410)
+
+# Probes a name's hit rate is pulled towards the mean by, so names seen a
+# few times don't jump ahead of ones with a long record
+PRIOR_WEIGHT = 20
+
+
+def dir_prefix(name):
+    """Directory of a name with more below it, `.git/` for `.git/config`"""
+    head, sep, rest = name.partition('/')
+    if sep and rest and head not in ('', '.', '..'):
+        return head + '/'
+    return None
+
+
+def is_requested(url, name_url):
+    """Whether the response is for the path probed, redirects only to
+    another scheme or host, or adding a trailing slash, don't move it"""
+    if url == name_url:
+        return True
+    if not url:
+        return False
+    return unquote(urlsplit(url).path).rstrip('/') == \
+        unquote(urlsplit(name_url).path).rstrip('/')
+
+
+class PathStats(object):
+    """
+    How often each name was probed and found, kept in a JSON file between
+    runs, so the names most likely to exist are probed first.
+    """
+    __slots__ = ('path', 'counts')
+
+    def __init__(self, path=None, load=True):
+        self.path = path
+        # name -> [probed, hits]
+        self.counts = dict()
+        if load and path and os.path.exists(path):
+            self.merge(path)
+
+    def merge(self, path):
+        """Add the counts from a stats file"""
+        try:
+            with open(path) as handle:
+                data = json.load(handle)
+        except ValueError:
+            LOG.warning("Ignoring unreadable path stats %r", path)
+            return
+        for name, (probed, hits) in data.get('names', {}).items():
+            counts = self.counts.setdefault(name, [0, 0])
+            counts[0] += probed
+            counts[1] += hits
+
+    def probed(self, name):
+        counts = self.counts.get(name)
+        if counts is None:
+            counts = self.counts[name] = [0, 0]
+        counts[0] += 1
+
+    def hit(self, name):
+        counts = self.counts.get(name)
+        if counts is None:
+            counts = self.counts[name] = [0, 0]
+        counts[1] += 1
+
+    def order(self, names):
+        """Names by hit rate, most likely first, names never probed keep
+        their place after the better than average ones"""
+        probed = sum([counts[0] for counts in self.counts.values()])
+        if not probed:
+            return list(names)
+        mean = float(sum([counts[1] for counts in self.counts.values()])) / probed
+
+        def score(name):
+            probed, hits = self.counts.get(name, (0, 0))
+            return (hits + PRIOR_WEIGHT * mean) / (probed + PRIOR_WEIGHT)
+        return sorted(names, key=score, reverse=True)
+
+    def save(self, path=None):
+        path = path or self.path
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as handle:
+            json.dump(dict(names=self.counts), handle)
+        os.rename(tmp, path)
+
+
+class PathPlan(object):
+    """
+    Order in which each host's names are probed. Entries are names, or a
+    (directory, names) group for names below a directory: the directory is
+    probed first, and the names are only probed if it isn't missing. When
+    the directory isn't a name itself it's `synthetic`, probed only to
+    decide the group.
+    """
+    __slots__ = ('entries', 'synthetic')
+
+    def __init__(self, names, stats=None, groups=True):
+        order = stats.order(names) if stats else list(names)
+        self.synthetic = set()
+        if not groups:
+            self.entries = order
+            return
+        members = dict()
+        for name in order:
+            prefix = dir_prefix(name)
+            if prefix:
+                members.setdefault(prefix, []).append(name)
+        present = set(order)
+        seen = set()
+        self.entries = []
+        for name in order:
+            prefix = dir_prefix(name) or name
+            if len(members.get(prefix, ())) < MIN_GROUP:
+                self.entries.append(name)
+                continue
+            # The group goes where its most likely name is
+            if prefix in seen:
+                continue
+            seen.add(prefix)
+            if prefix not in present:
+                self.synthetic.add(prefix)
+            self.entries.append((prefix, members[prefix]))
+        if seen:
+            LOG.info("%d directories grouping %d names", len(seen),
+                     sum([len(members[prefix]) for prefix in seen]))
@@ -0,0 +1,137 @@
+from __future__ import absolute_import
+import time
+import socket
+import logging
+from collections import OrderedDict
+
+import gevent
+import gevent.pool
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+try:
+    import dns.resolver
+    import dns.exception
+except ImportError:
+    dns = None
+
+
+LOG = logging.getLogger(__name__)
+
+# Seconds to remember unresolvable hosts, and resolvable ones when the
+# record TTL isn't known
+NEGATIVE_TTL = 60
+DEFAULT_TTL = 300
+
+# getaddrinfo errors which mean the name definitely doesn't resolve
+_NXDOMAIN_ERRORS = set([getattr(socket, name) for name in
+                        ('EAI_NONAME', 'EAI_NODATA', 'EAI_ADDRFAMILY')
+                        if hasattr(socket, name)])
+
+
+def _is_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            continue
+    return False
+
+
+class Resolver(object):
+    """
+    Resolves domains before any HTTP work is done, so dead domains are
+    dropped up-front. Answers are cached, positive ones for the record TTL
+    when dnspython is available, and failures are retried `retries` times.
+    Domains reached through a proxy from the environment are kept, the
+    proxy may resolve names we can't, e.g. with socks5h or Tor.
+    """
+    __slots__ = ('retries', 'timeout', 'ttl', 'concurrency', 'cache',
+                 'cache_size', 'metrics')
+
+    def __init__(self, options, metrics=None, cache_size=1024 * 100):
+        self.retries = max(0, options.retries)
+        self.timeout = options.timeout
+        self.ttl = options.dns_ttl
+        self.concurrency = options.resolvers or options.concurrency
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.metrics = metrics
+
+    def _lookup_dnspython(self, host):
+        """Returns (resolves, ttl), or None on transient failure"""
+        resolve = getattr(dns.resolver, 'resolve', None) or dns.resolver.query
+        for rdtype in ('A', 'AAAA'):
+            try:
+                answer = resolve(host, rdtype, lifetime=self.timeout)
+                return True, answer.rrset.ttl
+            except dns.resolver.NoAnswer:
+                continue
+            except dns.resolver.NXDOMAIN:
+                return False, NEGATIVE_TTL
+            except dns.exception.DNSException:
+                return None
+        return False, NEGATIVE_TTL
+
+    def _lookup_system(self, host):
+        """Returns (resolves, ttl), or None on transient failure"""
+        try:
+            with gevent.Timeout(self.timeout):
+                socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+            return True, self.ttl
+        except socket.gaierror as ex:
+            if ex.errno in _NXDOMAIN_ERRORS:
+                return False, NEGATIVE_TTL
+        except gevent.Timeout:
+            pass
+        return None
+
+    def _lookup(self, host):
+        lookup = self._lookup_dnspython if dns else self._lookup_system
+        for attempt in range(self.retries + 1):
+            result = lookup(host)
+            if result is not None:
+                return result
+            LOG.debug("DNS lookup for %r failed, attempt %d", host, attempt + 1)
+        return False, NEGATIVE_TTL
+
+    def resolves(self, host):
+        if not host or _is_address(host):
+            return True
+        now = time.time()
+        cached = self.cache.get(host)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        found, ttl = self._lookup(host)
+        self.cache.pop(host, None)
+        self.cache[host] = (now + ttl, found)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return found
+
+    def _check(self, worker):
+        # Imported here, the command line reads our defaults before patching
+        from requests.utils import get_environ_proxies
+        if get_environ_proxies(worker.url):
+            return worker
+        host = urlsplit(worker.url).hostname
+        if self.resolves(host):
+            return worker
+        LOG.debug("Dropping %r, does not resolve", worker.domain)
+        if self.metrics:
+            self.metrics.error('dns')
+        worker.finish()
+        return None
+
+    def filter(self, workers):
+        """Yields the workers whose domain resolves, in the order lookups
+        complete, with up to `concurrency` lookups in-flight"""
+        pool = gevent.pool.Pool(self.concurrency)
+        for worker in pool.imap_unordered(self._check, workers,
+                                          maxsize=self.concurrency):
+            if worker is not None:
+                yield worker
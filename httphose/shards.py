@@ -0,0 +1,229 @@
+from __future__ import absolute_import, print_function
+import os
+import copy
+import json
+import zlib
+import logging
+
+import gevent
+import gevent.queue
+from gevent.fileobject import FileObject
+
+from .hose import HTTPHose
+from .paths import PathStats
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between progress and metrics reports from each shard
+REPORT_INTERVAL = 1.0
+
+
+def shard_of(domain, count):
+    """Stable shard number for the domain's host"""
+    url = domain if '://' in domain else 'http://' + domain
+    host = urlsplit(url.strip()).hostname or domain
+    return (zlib.crc32(host.encode('utf-8')) & 0xFFFFFFFF) % count
+
+
+class PipeSink(object):
+    """
+    Result sink for a shard process: results, progress and metrics are
+    written as tagged JSON lines to the parent, which does the output.
+    """
+    __slots__ = ('hose', 'handle', 'reporter', 'queue')
+
+    def __init__(self, hose, handle):
+        self.hose = hose
+        self.handle = handle
+        self.reporter = None
+        # Results aren't queued, this is for the results_queued gauge
+        self.queue = gevent.queue.Queue()
+
+    def start(self):
+        if self.reporter is None:
+            self.reporter = gevent.spawn(self._report_forever)
+
+    def put(self, status):
+        self.handle.write(b'R' + json.dumps(status).encode('utf-8') + b'\n')
+
+    def _report(self):
+        report = dict(finished=self.hose.finished,
+                      metrics=self.hose.metrics.snapshot())
+        self.handle.write(b'M' + json.dumps(report).encode('utf-8') + b'\n')
+        self.handle.flush()
+
+    def _report_forever(self):
+        while True:
+            gevent.sleep(REPORT_INTERVAL)
+            self._report()
+
+    def close(self):
+        if self.reporter is not None:
+            self.reporter.kill()
+            self.reporter = None
+        self._report()
+        self.handle.close()
+
+
+class ShardedHose(HTTPHose):
+    """
+    Runs the hose in `--workers` forked processes. Domains are sent to the
+    process chosen by a hash of their host, so per-host state stays in one
+    process, and every process sends its results and metrics back to this
+    one, which does all of the output. With beanstalk each process fetches
+    its own jobs.
+    """
+    __slots__ = ('shards', 'reports')
+
+    def __init__(self, options):
+        self.shards = []
+        self.reports = dict()
+        super(ShardedHose, self).__init__(options)
+        # Shard processes do the probing and storing, each opening the index
+        self.storage = None
+        if self.index:
+            self.index.close()
+            self.index = None
+
+    def _setup_options(self, options):
+        # Each shard keeps its own journal, skipping is done in the shards
+        journal, options.journal = options.journal, None
+        super(ShardedHose, self)._setup_options(options)
+        options.journal = journal
+
+    def _shard_options(self, shard):
+        options = copy.copy(self.options)
+        options.workers = 1
+        options.domain = []
+        options.domains = None
+        options.names = self.names_index
+        options.output = None
+        options.quiet = True
+        options.progress = False
+        options.metrics_port = None
+        options.metrics_file = None
+        if options.journal:
+            options.journal = '%s.%d' % (options.journal, shard)
+        if options.path_stats:
+            options.path_stats = '%s.%d' % (options.path_stats, shard)
+        return options
+
+    def _run_shard(self, shard, domains_fd, results_fd):
+        hose = HTTPHose(self._shard_options(shard))
+        # Names are probed in the order planned here, and the shard's stats
+        # are only this run's, to be merged into ours
+        hose.plan = self.plan
+        if hose.stats:
+            hose.stats = PathStats(hose.stats.path, load=False)
+        if not self.beanstalk:
+            hose.domains = self._read_domains(hose, FileObject(domains_fd, 'rb'))
+        hose.sink = PipeSink(hose, FileObject(results_fd, 'wb'))
+        hose.run()
+
+    def _read_domains(self, hose, handle):
+        for line in handle:
+            index, domain = line.rstrip(b'\n').split(b'\t', 1)
+            index = int(index)
+            if hose.journal and hose.journal.is_done(index):
+                continue
+            yield index, domain.decode('utf-8')
+
+    def _fork(self, shard, inherited):
+        domains_read, domains_write = os.pipe()
+        results_read, results_write = os.pipe()
+        pid = gevent.fork()
+        if pid == 0:
+            status = 0
+            try:
+                for fd in inherited + [domains_write, results_read]:
+                    os.close(fd)
+                self._run_shard(shard, domains_read, results_write)
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                LOG.exception("Shard %d failed", shard)
+                status = 1
+            os._exit(status)
+        os.close(domains_read)
+        os.close(results_write)
+        inherited += [domains_write, results_read]
+        return pid, domains_write, results_read
+
+    def _dispatch(self, handles):
+        try:
+            for index, domain in self.domains:
+                shard = shard_of(domain, len(handles))
+                handles[shard].write(('%d\t%s\n' % (index, domain)).encode('utf-8'))
+        finally:
+            for handle in handles:
+                handle.close()
+
+    def _collect(self, shard, handle):
+        for line in handle:
+            kind, data = line[:1], line[1:]
+            try:
+                data = json.loads(data.decode('utf-8'))
+            except ValueError:
+                LOG.warning("Bad line from shard %d: %r", shard, line[:100])
+                continue
+            if kind == b'R':
+                # Already counted and extended in the shard
+                self.sink.put(data)
+            elif kind == b'M':
+                self.reports[shard] = data
+                self.metrics.absorb(shard, data['metrics'])
+                self.finished = sum([report['finished']
+                                     for report in self.reports.values()])
+                self.on_probe(0)
+        handle.close()
+
+    def _merge_stats(self):
+        for shard in range(len(self.shards)):
+            path = '%s.%d' % (self.stats.path, shard)
+            if os.path.exists(path):
+                self.stats.merge(path)
+                os.unlink(path)
+        self.stats.save()
+
+    def run(self):
+        # Fork before starting any greenlets, or they'd run in every shard
+        inherited = []
+        for shard in range(self.options.workers):
+            self.shards.append(self._fork(shard, inherited))
+        if self.progress:
+            total = None
+            if isinstance(self.domains, list):
+                total = len(self.domains) * len(self.names)
+            self.progress.start(total)
+        self.metrics.start(self.options.metrics_port, self.options.metrics_file,
+                           self.options.metrics_interval)
+        self.sink.start()
+        collectors = [gevent.spawn(self._collect, shard,
+                                   FileObject(results_fd, 'rb'))
+                      for shard, (_, _, results_fd) in enumerate(self.shards)]
+        domains = [FileObject(domains_fd, 'wb')
+                   for _, domains_fd, _ in self.shards]
+        try:
+            if self.beanstalk:
+                for handle in domains:
+                    handle.close()
+            else:
+                self._dispatch(domains)
+            gevent.joinall(collectors)
+        except KeyboardInterrupt:
+            print("Ctrl+C caught... waiting for workers to stop")
+            gevent.joinall(collectors)
+        for pid, _, _ in self.shards:
+            os.waitpid(pid, 0)
+        if self.stats:
+            self._merge_stats()
+        self.sink.close()
+        self.metrics.stop(self.options.metrics_file)
+        if self.progress:
+            self.progress.finish()
@@ -0,0 +1,230 @@
+from __future__ import absolute_import, print_function
+import json
+import time
+import logging
+
+import gevent
+import gevent.queue
+
+
+LOG = logging.getLogger(__name__)
+
+FORMATS = ('jsonl', 'jsonl.gz', 'jsonl.zst', 'msgpack')
+
+_EXTENSIONS = (
+    ('.gz', 'jsonl.gz'),
+    ('.zst', 'jsonl.zst'),
+    ('.msgpack', 'msgpack'),
+    ('.mpk', 'msgpack'),
+)
+
+
+def guess_format(handle):
+    """Output format from the file extension, defaults to JSON lines"""
+    name = getattr(handle, 'name', None)
+    if isinstance(name, str):
+        for ext, fmt in _EXTENSIONS:
+            if name.endswith(ext):
+                return fmt
+    return 'jsonl'
+
+
+def encode(batch):
+    """The results which could be JSON encoded, and their lines"""
+    statuses = []
+    lines = []
+    for status in batch:
+        try:
+            lines.append(json.dumps(status))
+        except Exception:
+            LOG.exception("Failed to encode a result")
+            continue
+        statuses.append(status)
+    return statuses, lines
+
+
+class JSONLinesEncoder(object):
+    __slots__ = ('handle',)
+
+    def __init__(self, handle):
+        self.handle = handle
+
+    def write(self, statuses, lines):
+        self.handle.write(("\n".join(lines) + "\n").encode('utf-8'))
+        self.handle.flush()
+
+    def close(self):
+        self.handle.flush()
+
+
+class GzipEncoder(JSONLinesEncoder):
+    """JSON lines in a gzip member, sync-flushed after every batch so the
+    file can be read while it's being written"""
+    __slots__ = ('gzip',)
+
+    def __init__(self, handle):
+        import gzip
+        super(GzipEncoder, self).__init__(handle)
+        self.gzip = gzip.GzipFile(fileobj=handle, mode='wb')
+
+    def write(self, statuses, lines):
+        self.gzip.write(("\n".join(lines) + "\n").encode('utf-8'))
+        self.gzip.flush()
+        self.handle.flush()
+
+    def close(self):
+        self.gzip.close()
+        self.handle.flush()
+
+
+class ZstdEncoder(JSONLinesEncoder):
+    __slots__ = ('zstd', 'flush_block', 'flush_frame')
+
+    def __init__(self, handle):
+        import zstandard
+        super(ZstdEncoder, self).__init__(handle)
+        self.zstd = zstandard.ZstdCompressor().stream_writer(handle)
+        self.flush_block = zstandard.FLUSH_BLOCK
+        self.flush_frame = zstandard.FLUSH_FRAME
+
+    def write(self, statuses, lines):
+        self.zstd.write(("\n".join(lines) + "\n").encode('utf-8'))
+        self.zstd.flush(self.flush_block)
+        self.handle.flush()
+
+    def close(self):
+        self.zstd.flush(self.flush_frame)
+        self.handle.flush()
+
+
+class MsgpackEncoder(JSONLinesEncoder):
+    """Stream of msgpack maps, one per result"""
+    __slots__ = ('packer',)
+
+    def __init__(self, handle):
+        import msgpack
+        super(MsgpackEncoder, self).__init__(handle)
+        self.packer = msgpack.Packer()
+
+    def write(self, statuses, lines):
+        self.handle.write(b''.join([self.packer.pack(status)
+                                    for status in statuses]))
+        self.handle.flush()
+
+
+ENCODERS = {
+    'jsonl': JSONLinesEncoder,
+    'jsonl.gz': GzipEncoder,
+    'jsonl.zst': ZstdEncoder,
+    'msgpack': MsgpackEncoder,
+}
+
+
+class ResultOutput(object):
+    """
+    Where each batch of results goes locally: printed unless `--quiet`, and
+    written to `--output`. Shared by both engines' writers, which then put
+    the encoded lines onto beanstalk themselves.
+    """
+    __slots__ = ('quiet', 'encoder')
+
+    def __init__(self, options):
+        self.quiet = options.quiet
+        self.encoder = None
+        if options.output:
+            fmt = options.format or guess_format(options.output)
+            self.encoder = ENCODERS[fmt](options.output)
+
+    def write(self, batch):
+        """Encode, print and write a batch, returns the results which could
+        be encoded and their lines. Nothing here raises"""
+        batch, lines = encode(batch)
+        if not lines:
+            return batch, lines
+        if not self.quiet:
+            try:
+                print("\n".join(lines))
+            except Exception:
+                # e.g. whatever reads stdout exited, results still go to
+                # the output file and beanstalk
+                LOG.exception("Failed to print %d results, no longer printing",
+                              len(batch))
+                self.quiet = True
+        if self.encoder:
+            try:
+                self.encoder.write(batch, lines)
+            except Exception:
+                LOG.exception("Failed to write %d results", len(batch))
+        return batch, lines
+
+    def close(self):
+        if self.encoder:
+            self.encoder.close()
+
+
+class ResultSink(object):
+    """
+    Results are queued in a bounded queue and written by a dedicated writer
+    greenlet, in batches of up to `flush_size` or whatever arrived within
+    `flush_interval` seconds. Each batch is JSON encoded once, printed, written
+    to the output file and put onto beanstalk as multi-row jobs.
+    """
+    __slots__ = ('output', 'beanstalk', 'flush_size', 'flush_interval',
+                 'queue', 'writer')
+
+    def __init__(self, options, beanstalk=None):
+        self.output = ResultOutput(options)
+        self.beanstalk = beanstalk
+        self.flush_size = max(1, options.flush_size)
+        self.flush_interval = options.flush_interval
+        self.queue = gevent.queue.Queue(self.flush_size * 4)
+        self.writer = None
+
+    def start(self):
+        if self.writer is None:
+            self.writer = gevent.spawn(self._run)
+
+    def put(self, status):
+        """Queue a result, blocks when the writer has fallen behind"""
+        self.queue.put(status)
+
+    def _flush(self, batch):
+        """Nothing here may raise, a dead writer would block `put()`"""
+        batch, lines = self.output.write(batch)
+        if lines and self.beanstalk:
+            try:
+                self.beanstalk.put_lines(lines)
+            except Exception:
+                LOG.exception("Failed to put %d results", len(batch))
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            try:
+                status = self.queue.get(timeout=timeout)
+            except gevent.queue.Empty:
+                status = None
+            if status is StopIteration:
+                break
+            if status is not None:
+                batch.append(status)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+            if batch and (len(batch) >= self.flush_size or time.time() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+        if batch:
+            self._flush(batch)
+
+    def close(self):
+        """Flush everything queued so far and stop the writer"""
+        if self.writer is not None:
+            self.queue.put(StopIteration)
+            self.writer.join()
+            self.writer = None
+        self.output.close()
@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+import os
+import errno
+import logging
+import tempfile
+from hashlib import sha1
+from base64 import b32encode
+
+import gevent.lock
+import gevent.threadpool
+
+
+LOG = logging.getLogger(__name__)
+
+# Bodies are held in memory up to this size, larger ones are written to a
+# temporary file on the thread pool this much at a time
+SPOOL_SIZE = 1024 * 1024
+
+# Bodies read but not yet written, each holds up to SPOOL_SIZE in memory
+MAX_PENDING = 32
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+def _discard(spool):
+    spool.close()
+    try:
+        os.unlink(spool.name)
+    except OSError:
+        pass
+
+
+class ContentStore(object):
+    """
+    Content addressable storage: each body is stored once, named by the
+    base32 SHA1 of its content and sharded two levels deep, `AB/CD/ABCD...`.
+    Bodies are hashed as they're read in the request greenlet, files are
+    written and renamed into place on a thread pool. At most `max_pending`
+    bodies wait to be written, further stores block until one has been.
+    """
+    __slots__ = ('root', 'tmpdir', 'threadpool', 'pending')
+
+    def __init__(self, root, threads=4, max_pending=MAX_PENDING):
+        self.root = root
+        self.tmpdir = os.path.join(root, 'tmp')
+        _makedirs(self.tmpdir)
+        self.threadpool = gevent.threadpool.ThreadPool(threads)
+        self.pending = gevent.lock.BoundedSemaphore(max_pending)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def store(self, chunks):
+        """Store the body read from `chunks`, returns its key once it's been
+        read, the file is written in the background"""
+        self.pending.acquire()
+        hasher = sha1()
+        parts = []
+        size = 0
+        spool = None
+        try:
+            for chunk in chunks:
+                hasher.update(chunk)
+                parts.append(chunk)
+                size += len(chunk)
+                if size >= SPOOL_SIZE:
+                    spool = self.threadpool.apply(self._spool, (spool, parts))
+                    parts = []
+                    size = 0
+        except BaseException:
+            if spool is not None:
+                self.threadpool.spawn(_discard, spool)
+            self.pending.release()
+            raise
+        key = b32encode(hasher.digest()).decode('ascii')
+        result = self.threadpool.spawn(self._commit, key, spool, parts)
+        result.rawlink(self._committed)
+        return key
+
+    def _spool(self, spool, parts):
+        """Append to a body's temporary file, created on the first call"""
+        if spool is None:
+            spool = tempfile.NamedTemporaryFile(dir=self.tmpdir, delete=False)
+        spool.write(b''.join(parts))
+        return spool
+
+    def _commit(self, key, spool, parts):
+        path = self.path(key)
+        try:
+            if not os.path.exists(path):
+                spool = self._spool(spool, parts)
+                spool.close()
+                _makedirs(os.path.dirname(path))
+                os.rename(spool.name, path)
+                spool = None
+        except Exception:
+            LOG.exception("Failed to store %r", key)
+        finally:
+            if spool is not None:
+                _discard(spool)
+
+    def _committed(self, result):
+        self.pending.release()
+
+    def close(self):
+        """Wait for pending writes to finish"""
+        self.threadpool.join()
+        self.threadpool.kill()
@@ -0,0 +1,242 @@
+from __future__ import absolute_import
+import ssl
+import time
+import logging
+from itertools import chain
+
+import gevent
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.poolmanager import ProxyManager
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, \
+    HTTPSConnectionPool
+from requests.packages.urllib3.util.ssl_ import create_urllib3_context
+
+try:
+    from urllib.parse import urlsplit
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from urlparse import urlsplit
+    from cookielib import DefaultCookiePolicy
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Leftover response bodies up to this size are read so the connection can go
+# back to its pool, larger ones are cheaper to abandon with the connection
+DRAIN_LIMIT = 1024 * 64
+
+# https://myip.ms/browse/comp_browseragents/Computer_Browser_Agents.html
+HTTP_USER_AGENTS = [
+"Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36",
+"Opera/9.80 (Windows NT 6.2; Win64; x64) Presto/2.12 Version/12.16",
+"Mozilla/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko",
+"Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; Trident/5.0)",
+"Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; WOW64; Trident/5.0)",
+"Mozilla/5.0 (Windows NT 6.3; WOW64; rv:45.0) Gecko/20100101 Firefox/45.0",
+"Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.1; WOW64; Trident/6.0)",
+"Mozilla/5.0 (Windows NT 6.1; Trident/7.0; rv:11.0) like Gecko",
+"Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 6.1; WOW64; Trident/5.0; SLCC2; .NET CLR 2.0.50727; .NET CLR 3.5.30729; .NET CLR 3.0.30729; Media Center PC 6.0; .NET4.0C; .NET4.0E)",
+"Mozilla/5.0 (Windows NT 5.1) AppleWebKit/537.11 (KHTML like Gecko) Chrome/23.0.1271.95 Safari/537.11",
+"Mozilla/5.0 (Macintosh; Intel Mac OS X 1094) AppleWebKit/537.77.4 (KHTML like Gecko) Version/7.0.5 Safari/537.77.4",
+"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/48.0.2564.48 Safari/537.36",
+"Mozilla/5.0 (Windows NT 5.1) AppleWebKit/537.11 (KHTML like Gecko) Chrome/23.0.1271.64 Safari/537.11",
+"Mozilla/5.0 (Windows NT 5.1; rv:31.0) Gecko/20100101 Firefox/31.0",
+"Mozilla/5.0 (Windows NT 6.3; WOW64; Trident/7.0; rv:11.0) like Gecko"
+]
+
+
+def timed_pool_classes(observe):
+    """Connection pool classes whose connections call `observe` with how
+    long connecting took, including any TLS handshake"""
+    classes = dict()
+    for scheme, pool_cls in (('http', HTTPConnectionPool),
+                             ('https', HTTPSConnectionPool)):
+        base = pool_cls.ConnectionCls
+
+        def connect(self, _base=base):
+            start = time.time()
+            _base.connect(self)
+            observe('connect', time.time() - start)
+
+        conn_cls = type('Timed' + base.__name__, (base,), {'connect': connect})
+        classes[scheme] = type('Timed' + pool_cls.__name__, (pool_cls,),
+                               {'ConnectionCls': conn_cls})
+    return classes
+
+
+class HoseAdapter(HTTPAdapter):
+    """
+    Shares one SSL context between every connection pool, including pools
+    behind HTTP and SOCKS proxies, and records when each host was last used
+    so idle pools can be evicted.
+    """
+    def __init__(self, ssl_context, pool_classes=None, **kwargs):
+        self.ssl_context = ssl_context
+        self.pool_classes = pool_classes
+        self.last_used = dict()
+        super(HoseAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **pool_kwargs):
+        pool_kwargs.setdefault('ssl_context', self.ssl_context)
+        super(HoseAdapter, self).init_poolmanager(*args, **pool_kwargs)
+        if self.pool_classes:
+            self.poolmanager.pool_classes_by_scheme = self.pool_classes
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs.setdefault('ssl_context', self.ssl_context)
+        manager = super(HoseAdapter, self).proxy_manager_for(proxy, **proxy_kwargs)
+        # SOCKS managers have their own connection classes
+        if self.pool_classes and type(manager) is ProxyManager:
+            manager.pool_classes_by_scheme = self.pool_classes
+        return manager
+
+    def send(self, request, *args, **kwargs):
+        parsed = urlsplit(request.url)
+        scheme = parsed.scheme.lower()
+        key = (scheme, parsed.hostname, parsed.port or DEFAULT_PORTS.get(scheme))
+        self.last_used[key] = time.time()
+        return super(HoseAdapter, self).send(request, *args, **kwargs)
+
+    def evict_idle(self, max_idle):
+        """Close connection pools for hosts unused for `max_idle` seconds"""
+        cutoff = time.time() - max_idle
+        idle = set([key for key, when in self.last_used.items()
+                    if when < cutoff])
+        if not idle:
+            return 0
+        for key in idle:
+            del self.last_used[key]
+        evicted = 0
+        managers = [self.poolmanager] + list(self.proxy_manager.values())
+        for manager in managers:
+            for pool_key in list(manager.pools.keys()):
+                host_key = (pool_key.key_scheme, pool_key.key_host,
+                            pool_key.key_port)
+                if host_key in idle:
+                    # Removing the pool from the container closes it
+                    manager.pools.pop(pool_key, None)
+                    evicted += 1
+        return evicted
+
+
+def whole_file(status, headers):
+    """Status and Content-Length as if the whole file had been asked for,
+    a 206 answers the Range of `--probe range`"""
+    if status != 206:
+        return status, headers.get('Content-Length')
+    total = (headers.get('Content-Range') or '').rpartition('/')[2].strip()
+    return 200, total if total.isdigit() else None
+
+
+class CappedBody(object):
+    """
+    Iterates over a streamed response body, starting with the `head` already
+    read, until `max_bytes` or `max_time` seconds are exceeded, when the
+    rest of the body is abandoned and `truncated` is set.
+    """
+    __slots__ = ('resp', 'head', 'max_bytes', 'max_time', 'truncated')
+
+    def __init__(self, resp, head=None, max_bytes=None, max_time=None):
+        self.resp = resp
+        self.head = head
+        self.max_bytes = max_bytes or None
+        self.max_time = max_time
+        self.truncated = False
+
+    def __iter__(self):
+        remaining = self.max_bytes
+        deadline = time.time() + self.max_time if self.max_time else None
+        chunks = self.resp.iter_content(chunk_size=1024 * 64)
+        if self.head:
+            chunks = chain([self.head], chunks)
+        for chunk in chunks:
+            if remaining is not None:
+                if len(chunk) >= remaining:
+                    yield chunk[:remaining]
+                    self.truncated = len(chunk) > remaining or \
+                        _has_more(self.resp)
+                    return
+                remaining -= len(chunk)
+            yield chunk
+            if deadline is not None and time.time() > deadline:
+                self.truncated = True
+                return
+
+
+def _has_more(resp):
+    try:
+        return bool(resp.raw.read(1, decode_content=False))
+    except Exception:
+        return True
+
+
+class Transport(object):
+    """
+    Process-wide HTTP transport shared by all workers: bounded keep-alive
+    pools per host, a single SSL context, pooled proxy connections, and a
+    reaper which evicts pools for hosts that have gone idle.
+    """
+    __slots__ = ('session', 'adapter', 'idle', 'reaper')
+
+    def __init__(self, options, metrics=None):
+        ssl_context = create_urllib3_context(cert_reqs=ssl.CERT_NONE)
+        pool_classes = timed_pool_classes(metrics.observe) if metrics else None
+        self.adapter = HoseAdapter(ssl_context, pool_classes,
+                                   pool_connections=options.keepalive_hosts,
+                                   pool_maxsize=options.per_host,
+                                   pool_block=False,
+                                   max_retries=0)
+        session = requests.Session()
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        session.max_redirects = options.redirects
+        session.verify = False
+        # Cookies are reported per-response, the shared jar would only grow
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.session = session
+        self.idle = options.idle
+        self.reaper = None
+
+    def get(self, url, headers, timeout, method='GET'):
+        return self.session.request(method, url, headers=headers, stream=True,
+                                    timeout=timeout, verify=False,
+                                    allow_redirects=True)
+
+    def multiplexed(self, resp):
+        """Whether the response came over a connection shared by streams"""
+        return False
+
+    def release(self, resp, limit=DRAIN_LIMIT):
+        """Return the response's connection to its pool when the rest of the
+        body is small enough to drain, otherwise close the connection"""
+        raw = resp.raw
+        try:
+            while limit > 0:
+                chunk = raw.read(min(limit, 1024 * 8), decode_content=False)
+                if not chunk:
+                    raw.release_conn()
+                    return
+                limit -= len(chunk)
+        except Exception:
+            pass
+        resp.close()
+
+    def _reap(self):
+        while True:
+            gevent.sleep(self.idle / 2.0)
+            evicted = self.adapter.evict_idle(self.idle)
+            if evicted:
+                LOG.debug("Evicted %d idle connection pools", evicted)
+
+    def start(self):
+        if self.reaper is None and self.idle > 0:
+            self.reaper = gevent.spawn(self._reap)
+
+    def close(self):
+        if self.reaper is not None:
+            self.reaper.kill()
+            self.reaper = None
+        self.session.close()